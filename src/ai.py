@@ -1,176 +1,460 @@
+import html
 import json
 import logging
 import os
-from datetime import datetime
-from typing import Mapping
+import re
+import time
+from contextlib import aclosing
+from datetime import date, datetime
+from typing import AsyncIterator, Iterable, Mapping
 
-from openai import OpenAI
+import metrics
+from ai_backends import Backend, Usage, create_backend
+from utils import Ranking
 
 logger = logging.getLogger(__name__)
 
+BACKEND = os.environ.get("AI_BACKEND", "openai")
 
-def make_query(
-    prompt: str, *args, logger_extra: Mapping[str, object] | None = None
+_backend: Backend | None = None
+
+
+def get_backend() -> Backend | None:
+    """
+    Returns the process wide backend, None if it isn't configured.
+    """
+    global _backend
+    if _backend is None:
+        _backend = create_backend(BACKEND)
+    return _backend
+
+
+def set_backend(backend: Backend | None) -> Backend | None:
+    """
+    Replaces the backend, like a local one for benchmarks. Returns the
+    previous one.
+    """
+    global _backend
+    previous, _backend = _backend, backend
+    return previous
+
+
+async def close():
+    global _backend
+    if _backend is not None:
+        await _backend.close()
+        _backend = None
+
+
+# Instructions shared by all prompts of a kind, always sent as the same system
+# message. The facts of a single prompt follow in a user message.
+GAME_INSTRUCTIONS = """
+Du bist {bot_name}, ein Bot in einer Telegram-Gruppe, die jeden Tag um 13:37 spielt.
+- Wer um 13:37 die erste Chatnachricht schreibt, bekommt einen Punkt
+- Man bekommt Punkte abgezogen, wenn man um 13:36 schreibt
+- Du bekommst Punkte für jeden Tag, an dem niemand um 13:37 schreibt
+- Im Quiz gibt es für eine richtige Antwort einen Punkt, für eine falsche einen Punkt Abzug
+Antworte auf Deutsch, lustig und frech, ohne den Punktestand vollständig aufzuzählen.
+""".strip()
+QUIZMASTER_INSTRUCTIONS = """
+Du bist ein Quizmaster. Stelle eine Frage zu dem heutigen Datum.
+Die Frage muss beantwortbar sein. Sie muss der Realität entsprechen, prüfe die Fakten genau.
+Die Frage darf nicht zu spezifisch sein, damit sie von den meisten beantwortet werden kann.
+Sie darf nicht zu einfach sein, damit nicht alle Teilnehmer die Antwort wissen.
+Gib keine Antwortmöglichkeiten an.
+""".strip()
+JUDGE_INSTRUCTIONS = """
+Bewerte Antworten auf eine Quizfrage. Prüfe die Fakten genau.
+Antworte für jede Antwort in einer eigenen Zeile mit ihrer Nummer und "Richtig" oder "Falsch",
+z.B. "1. Falsch". Bei nur einer Antwort antworte nur mit "Richtig" oder "Falsch".
+""".strip()
+
+PROMPT_TOKEN_BUDGET = int(os.environ.get("AI_PROMPT_TOKEN_BUDGET", 300))
+SCOREBOARD_TOP = int(os.environ.get("AI_SCOREBOARD_TOP", 5))
+# Characters of a chat message or answer that are quoted in a prompt
+QUOTE_LIMIT = 300
+
+
+def game_instructions(bot_name: str) -> str:
+    return GAME_INSTRUCTIONS.format(bot_name=bot_name)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    A rough upper estimate, German text averages more than three characters
+    per token.
+    """
+    return -(-len(text) // 3)
+
+
+def _quote(text: str) -> str:
+    if len(text) > QUOTE_LIMIT:
+        text = text[:QUOTE_LIMIT] + "…"
+    return f'"{text}"'
+
+
+def compact_scoreboard(
+    ranking: Ranking,
+    focus: Iterable[int] = (),
+    top: int = SCOREBOARD_TOP,
+    neighbors: int = 1,
 ) -> str:
-    api_key = os.environ.get("OPENAI_API_KEY")
-    if not api_key:
+    """
+    The ``top`` entries of the scoreboard and those around the ``focus`` users,
+    like the winner and the bot. Everyone else is summed up in a single line.
+    """
+    if not ranking:
+        return "Noch hat niemand Punkte"
+    ranks = []
+    for i, (_, _, score) in enumerate(ranking):
+        ranks.append(ranks[-1] if i and score == ranking[i - 1][2] else i + 1)
+    shown = set(range(min(top, len(ranking))))
+    focus = set(focus)
+    for i, (user_id, _, _) in enumerate(ranking):
+        if user_id in focus:
+            shown.update(
+                range(max(0, i - neighbors), min(len(ranking), i + neighbors + 1))
+            )
+    lines = []
+    previous = -1
+    for i in sorted(shown):
+        if i > previous + 1:
+            lines.append("…")
+        _, name, score = ranking[i]
+        lines.append(f"{ranks[i]}. {name}: {score}")
+        previous = i
+    hidden = [score for i, (_, _, score) in enumerate(ranking) if i not in shown]
+    if hidden:
+        lines.append(
+            f"({len(hidden)} weitere mit {min(hidden)} bis {max(hidden)} Punkten)"
+        )
+    return "\n".join(lines)
+
+
+def build_prompt(
+    task: str,
+    facts: Iterable[str] = (),
+    ranking: Ranking | None = None,
+    focus: Iterable[int] = (),
+    budget: int = PROMPT_TOKEN_BUDGET,
+) -> str:
+    """
+    The user message of a prompt: the task, its facts and a compact scoreboard.
+    The scoreboard shows fewer entries until the estimated tokens of the
+    message fit into ``budget``, the focus users are always shown.
+    """
+    text = "\n".join([task, *[f"- {fact}" for fact in facts]])
+    if ranking is None:
+        return text
+    focus = list(focus)
+    top, neighbors = SCOREBOARD_TOP, 1
+    while True:
+        scoreboard = compact_scoreboard(ranking, focus, top, neighbors)
+        prompt = f"{text}\n- Aktueller Punktestand:\n{scoreboard}"
+        if estimate_tokens(prompt) <= budget or not (top or neighbors):
+            return prompt
+        if top:
+            top -= 1
+        else:
+            neighbors -= 1
+
+
+def _log_query(messages: list[dict], logger_extra: Mapping[str, object] | None):
+    logger.info(
+        f"""Making query: <pre>
+{html.escape(json.dumps(messages, indent=2, ensure_ascii=False))}
+</pre>""",
+        extra=logger_extra,
+    )
+
+
+def _count_tokens(prompt_type: str, usage: Usage):
+    logger.info(
+        f"{prompt_type} query used {usage.prompt_tokens} prompt and "
+        f"{usage.completion_tokens} completion tokens"
+    )
+    metrics.OPENAI_PROMPT_TOKENS.labels(prompt_type).observe(usage.prompt_tokens)
+    metrics.OPENAI_TOKENS.labels(prompt_type, "prompt").inc(usage.prompt_tokens)
+    metrics.OPENAI_TOKENS.labels(prompt_type, "completion").inc(usage.completion_tokens)
+
+
+async def make_query(
+    prompt: str,
+    *args,
+    prompt_type: str = "other",
+    logger_extra: Mapping[str, object] | None = None,
+) -> str:
+    backend = get_backend()
+    if backend is None:
         logger.error("OPENAI_API_KEY not set")
         return "Couldn't reach OpenAI"
-    client = OpenAI(
-        api_key=api_key,
-    )
     messages = [
         {"role": "system", "content": prompt},
         *args,
     ]
+    _log_query(messages, logger_extra)
+    with metrics.OPENAI_QUERY_LATENCY.labels(prompt_type).time():
+        completion = await backend.complete(messages, prompt_type)
+    if completion.usage:
+        _count_tokens(prompt_type, completion.usage)
     logger.info(
-        f"""Making query: <pre>
-{json.dumps(messages, indent=2)}
-</pre>""",
-        extra=logger_extra,
+        f"Response: <code>{html.escape(completion.text)}</code>", extra=logger_extra
     )
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        # model="gpt-4-turbo-preview",  # long response times
-        messages=messages,
+    return completion.text
+
+
+async def stream_query(
+    prompt: str,
+    *args,
+    prompt_type: str = "other",
+    logger_extra: Mapping[str, object] | None = None,
+) -> AsyncIterator[str]:
+    """
+    Like ``make_query``, but yields the completion in chunks while it is
+    generated.
+    """
+    backend = get_backend()
+    if backend is None:
+        logger.error("OPENAI_API_KEY not set")
+        yield "Couldn't reach OpenAI"
+        return
+    messages = [
+        {"role": "system", "content": prompt},
+        *args,
+    ]
+    _log_query(messages, logger_extra)
+    start = time.perf_counter()
+    parts = []
+    async with aclosing(backend.stream(messages, prompt_type)) as chunks:
+        async for chunk in chunks:
+            if chunk.usage:
+                _count_tokens(prompt_type, chunk.usage)
+            if chunk.text:
+                if not parts:
+                    metrics.OPENAI_FIRST_CHUNK_LATENCY.labels(prompt_type).observe(
+                        time.perf_counter() - start
+                    )
+                parts.append(chunk.text)
+                yield chunk.text
+    metrics.OPENAI_QUERY_LATENCY.labels(prompt_type).observe(
+        time.perf_counter() - start
+    )
+    logger.info(
+        f"Response: <code>{html.escape(''.join(parts))}</code>", extra=logger_extra
     )
-    logger.info(f"Response: <code>{response}</code>", extra=logger_extra)
-    return response.choices[0].message.content
 
 
-def get_too_early_message(
+async def get_too_early_message(
+    bot_name: str,
     username: str,
     chatmessage: str,
     points_left: int,
     logger_extra: Mapping[str, object] | None = None,
 ) -> str:
-    prompt = f"""
-{username} hat heute um 13:36 statt 13:37 eine Chatnachricht geschrieben und damit einen Punkt verloren.
-Die Person hat jetzt noch {points_left}. Die Nachricht war: "{chatmessage}". Beleidige die Person lustig dafür.
-"""
-    return make_query(prompt, logger_extra=logger_extra)
+    prompt = build_prompt(
+        f"{username} hat heute um 13:36 statt 13:37 eine Chatnachricht geschrieben "
+        "und damit einen Punkt verloren. Beleidige die Person lustig dafür.",
+        [
+            f"Punkte von {username}: {points_left}",
+            f"Die Nachricht war: {_quote(chatmessage)}",
+        ],
+    )
+    return await make_query(
+        game_instructions(bot_name),
+        {"role": "user", "content": prompt},
+        prompt_type="too_early",
+        logger_extra=logger_extra,
+    )
 
 
-def get_success_message(
+async def get_success_message(
     bot_name: str,
     username: str,
     chatmessage: str,
-    current_scores: str,
+    ranking: Ranking,
     bot_wins_extra: int = 0,
+    focus: Iterable[int] = (),
     logger_extra: Mapping[str, object] | None = None,
 ) -> str:
+    task = (
+        f"{username} hat heute um 13:37 die erste Chatnachricht geschrieben und damit "
+        "einen Punkt erhalten. Gib eine lustige Antwort auf die Nachricht. Mache dich "
+        "über den Punktestand lustig."
+    )
     if bot_wins_extra > 0:
-        extra_text = (
-            f"Weil die letzten {bot_wins_extra} Tage niemand um 13:37 geschrieben hat, hast "
-            f"du {bot_wins_extra} Punkt(e) erhalten. Mache dich darüber besonders lustig.\n"
+        task += (
+            f" Weil die letzten {bot_wins_extra} Tage niemand um 13:37 geschrieben hat, "
+            f"hast du {bot_wins_extra} Punkt(e) erhalten. Mache dich darüber besonders lustig."
         )
-    else:
-        extra_text = ""
-    now = datetime.now()
-    prompt = f"""
-Du bist {bot_name}. {username} hat heute um 13:37 die erste Chatnachricht geschrieben und damit einen Punkt erhalten.
-Gib eine lustige Antwort auf seine Nachricht. Mache dich über den Punktestand aller Teilnehmer lustig.
-{extra_text}
-- Heute ist der {now.strftime("%d.%m.%Y")}
-- Der Inhalt der Chatnachricht ist: "{chatmessage}"
-- Aktuelle Punktzahl:
-{current_scores}
-- Man bekommt Punkte abgezogen, wenn man um 13:36 schreibt
-- Du bekommst Punkte für jeden Tag, an dem jemand anders NICHT um 13:37 schreibt"""
-    return make_query(prompt, logger_extra=logger_extra)
+    prompt = build_prompt(
+        task,
+        [
+            f"Heute ist der {datetime.now():%d.%m.%Y}",
+            f"Der Inhalt der Chatnachricht ist: {_quote(chatmessage)}",
+        ],
+        ranking,
+        focus,
+    )
+    return await make_query(
+        game_instructions(bot_name),
+        {"role": "user", "content": prompt},
+        prompt_type="success",
+        logger_extra=logger_extra,
+    )
 
 
-def get_lost_message(
+async def get_lost_message(
     bot_name: str,
     username: str,
     chatmessage: str,
-    current_scores: str,
+    ranking: Ranking,
     bot_points: int,
+    focus: Iterable[int] = (),
     logger_extra: Mapping[str, object] | None = None,
 ) -> str:
-    now = datetime.now()
-    prompt = f"""
-Du bist {bot_name}.
-Weil die Chatteilnehmer die letzten {bot_points} Tage vergessen haben,
-um 13:37 zu schreiben, hast du {bot_points} Punkt(e) erhalten.
-Mache dich über den Punktestand aller Teilnehmer lustig. Achte genau darauf, auf welchem Platz du selbst bist.
-Mache dich über die letzte Nachricht lustig.
-
-- Heute ist der {now.strftime("%d.%m.%Y")}
-- Letzte Nachricht (von {username}): "{chatmessage}"
-- Aktuelle Punktzahl:
-{current_scores}
-- Man bekommt Punkte abgezogen, wenn man um 13:36 schreibt
-- Du bekommst Punkte für jeden Tag, an dem jemand anders NICHT um 13:37 schreibt"""
-    return make_query(prompt, logger_extra=logger_extra)
+    prompt = build_prompt(
+        f"Weil die Chatteilnehmer die letzten {bot_points} Tage vergessen haben, um 13:37 "
+        f"zu schreiben, hast du {bot_points} Punkt(e) erhalten. Mache dich über den "
+        "Punktestand lustig, achte genau darauf, auf welchem Platz du selbst bist. "
+        "Mache dich über die letzte Nachricht lustig.",
+        [
+            f"Heute ist der {datetime.now():%d.%m.%Y}",
+            f"Letzte Nachricht (von {username}): {_quote(chatmessage)}",
+        ],
+        ranking,
+        focus,
+    )
+    return await make_query(
+        game_instructions(bot_name),
+        {"role": "user", "content": prompt},
+        prompt_type="lost",
+        logger_extra=logger_extra,
+    )
 
 
-def get_challenge_message(logger_extra: Mapping[str, object] | None = None) -> str:
-    now = datetime.now()
-    prompt = f"""
-Du bist ein Quizmaster. Stelle eine Frage zu dem heutigen Datum, den {now.strftime("%d.%m")}.
-Die Frage muss beantwortbar sein. Sie muss der Realität entsprechen, prüfe die Fakten genau.
-Die Frage darf nicht zu spezifisch sein, damit sie von den meisten beantwortet werden kann.
-Sie darf nicht zu einfach sein, damit nicht alle Teilnehmer die Antwort wissen.
-Gib keine Antwortmöglichkeiten an.
-"""
-    return make_query(prompt, logger_extra=logger_extra)
+async def get_challenge_message(
+    day: date | None = None, logger_extra: Mapping[str, object] | None = None
+) -> str:
+    day = day or datetime.now()
+    return await make_query(
+        QUIZMASTER_INSTRUCTIONS,
+        {"role": "user", "content": f"Das heutige Datum ist der {day:%d.%m}."},
+        prompt_type="challenge",
+        logger_extra=logger_extra,
+    )
 
 
-def answer_is_correct(
+async def answer_is_correct(
     question: str, answer: str, logger_extra: Mapping[str, object] | None = None
-) -> bool:
-    prompt = f"""
-    Bewerte die Antwort auf eine Quizfrage. Antworte nur mit "Richtig" oder "Falsch".
-    Prüfe die Fakten genau.
-    Frage: "{question}"
-    """
-    response = make_query(
-        prompt,
-        {"role": "user", "content": answer},
+) -> bool | None:
+    """
+    None if the response is neither "Richtig" nor "Falsch".
+    """
+    response = await make_query(
+        JUDGE_INSTRUCTIONS,
+        {
+            "role": "user",
+            "content": f"Frage: {_quote(question)}\nAntwort: {_quote(answer)}",
+        },
+        prompt_type="judge",
         logger_extra=logger_extra,
     )
     logger.info(f"AI response: {response}")
-    return "richtig" in response.strip().lower()
+    response = response.strip().lower()
+    if "richtig" in response:
+        return True
+    if "falsch" in response:
+        return False
+    return None
 
 
-def get_challenge_won_message(
+async def judge_answers(
+    question: str,
+    answers: list[str],
+    logger_extra: Mapping[str, object] | None = None,
+) -> list[bool | None]:
+    """
+    Judges several answers to the same question with a single query. Answers
+    without a verdict in the response are judged one by one, those still
+    undecided are None.
+    """
+    if len(answers) == 1:
+        return [await answer_is_correct(question, answers[0], logger_extra)]
+    response = await make_query(
+        JUDGE_INSTRUCTIONS,
+        {
+            "role": "user",
+            "content": "\n".join(
+                [
+                    f"Frage: {_quote(question)}",
+                    "Antworten:",
+                    *[f"{i}. {_quote(answer)}" for i, answer in enumerate(answers, 1)],
+                ]
+            ),
+        },
+        prompt_type="judge",
+        logger_extra=logger_extra,
+    )
+    logger.info(f"AI response: {response}")
+    verdicts: list[bool | None] = [None] * len(answers)
+    for number, verdict in re.findall(r"(\d+)\D*?(richtig|falsch)", response, re.I):
+        if 0 < int(number) <= len(answers):
+            verdicts[int(number) - 1] = verdict.lower() == "richtig"
+    for i, verdict in enumerate(verdicts):
+        if verdict is None:
+            verdicts[i] = await answer_is_correct(question, answers[i], logger_extra)
+    return verdicts
+
+
+def stream_challenge_won_message(
     *,
     bot_name: str,
     username: str,
-    current_scores: str,
+    ranking: Ranking,
     question: str,
     answer: str,
+    focus: Iterable[int] = (),
     logger_extra: Mapping[str, object] | None = None,
-) -> str:
-    prompt = f"""
-Du bist {bot_name}.
-Weil {username} die Quizfrage richtig beantwortet hat, hat er einen Punkt erhalten.
-Lobe {username} für die Antwort, mache dich über die übrigen Teilnehmer lustig.
-Gib Fun-Facts zu der Frage und der Antwort.
-
-- Die Quizfrage lautete: "{question}"
-- Die Antwort von {username} war: "{answer}"
-- Aktuelle Punktzahl:
-{current_scores}
-"""
-    return make_query(prompt, logger_extra=logger_extra)
+) -> AsyncIterator[str]:
+    prompt = build_prompt(
+        f"Weil {username} die Quizfrage richtig beantwortet hat, hat er einen Punkt "
+        f"erhalten. Lobe {username} für die Antwort, mache dich über die übrigen "
+        "Teilnehmer lustig. Gib Fun-Facts zu der Frage und der Antwort.",
+        [
+            f"Die Quizfrage lautete: {_quote(question)}",
+            f"Die Antwort von {username} war: {_quote(answer)}",
+        ],
+        ranking,
+        focus,
+    )
+    return stream_query(
+        game_instructions(bot_name),
+        {"role": "user", "content": prompt},
+        prompt_type="challenge_won",
+        logger_extra=logger_extra,
+    )
 
 
-def get_challenge_lost_message(
+def stream_challenge_lost_message(
     *,
     bot_name: str,
     username: str,
-    current_scores: str,
     question: str,
     answer: str,
     logger_extra: Mapping[str, object] | None = None,
-) -> str:
-    prompt = f"""
-Weil {username} die Quizfrage nicht richtig beantwortet hat, hat er einen Punkt verloren und du einen Punkt erhalten.
-Mache dich über die Antwort von {username} lustig. Gib NICHT die richtige Antwort an.
-
-- Die Quizfrage lautete: "{question}"
-- Die Antwort von {username} war: "{answer}"
-    """
-    return make_query(prompt, logger_extra=logger_extra)
+) -> AsyncIterator[str]:
+    prompt = build_prompt(
+        f"Weil {username} die Quizfrage nicht richtig beantwortet hat, hat er einen "
+        "Punkt verloren und du einen Punkt erhalten. Mache dich über die Antwort von "
+        f"{username} lustig. Gib NICHT die richtige Antwort an.",
+        [
+            f"Die Quizfrage lautete: {_quote(question)}",
+            f"Die Antwort von {username} war: {_quote(answer)}",
+        ],
+    )
+    return stream_query(
+        game_instructions(bot_name),
+        {"role": "user", "content": prompt},
+        prompt_type="challenge_lost",
+        logger_extra=logger_extra,
+    )
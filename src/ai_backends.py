@@ -0,0 +1,236 @@
+"""
+Backends answering the queries of ``ai``, chosen with ``AI_BACKEND``:
+
+- ``openai`` (default) queries the OpenAI API, it is unavailable without an
+  ``OPENAI_API_KEY``
+- ``local`` answers offline with scripted or templated texts, after a
+  configurable latency and with a configurable error rate. It lets tests and
+  benchmarks run the AI code paths of the handlers without a network.
+"""
+
+import asyncio
+import json
+import os
+import random
+import re
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from itertools import count
+from typing import AsyncIterator
+
+import httpx
+from openai import AsyncOpenAI
+
+MODEL = "gpt-3.5-turbo"
+# MODEL = "gpt-4-turbo-preview"  # long response times
+
+
+@dataclass
+class Usage:
+    prompt_tokens: int
+    completion_tokens: int
+
+
+@dataclass
+class Completion:
+    """
+    A whole completion, or one chunk of a streamed one. The usage is only set
+    on the last chunk of a stream.
+    """
+
+    text: str
+    usage: Usage | None = None
+
+
+class BackendError(Exception):
+    pass
+
+
+class Backend(ABC):
+    @abstractmethod
+    async def complete(self, messages: list[dict], prompt_type: str) -> Completion:
+        """
+        The whole completion of ``messages``.
+        """
+
+    @abstractmethod
+    def stream(
+        self, messages: list[dict], prompt_type: str
+    ) -> AsyncIterator[Completion]:
+        """
+        The completion of ``messages`` in chunks, as an async generator.
+        """
+
+    async def close(self):
+        pass
+
+
+class OpenAIBackend(Backend):
+    """
+    Uses a single client for the whole process. It keeps its connections
+    alive, so consecutive queries don't pay for a new TLS handshake.
+    """
+
+    def __init__(self, api_key: str, model: str = MODEL):
+        self.model = model
+        max_connections = int(os.environ.get("OPENAI_MAX_CONNECTIONS", 20))
+        self.client = AsyncOpenAI(
+            api_key=api_key,
+            timeout=httpx.Timeout(
+                float(os.environ.get("OPENAI_TIMEOUT", 30)),
+                connect=float(os.environ.get("OPENAI_CONNECT_TIMEOUT", 5)),
+            ),
+            max_retries=int(os.environ.get("OPENAI_MAX_RETRIES", 2)),
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=max_connections,
+                    keepalive_expiry=float(
+                        os.environ.get("OPENAI_KEEPALIVE_EXPIRY", 60)
+                    ),
+                ),
+            ),
+        )
+
+    async def complete(self, messages: list[dict], prompt_type: str) -> Completion:
+        response = await self.client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+        )
+        usage = None
+        if response.usage:
+            usage = Usage(
+                response.usage.prompt_tokens, response.usage.completion_tokens
+            )
+        return Completion(response.choices[0].message.content, usage)
+
+    async def stream(
+        self, messages: list[dict], prompt_type: str
+    ) -> AsyncIterator[Completion]:
+        stream = await self.client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        try:
+            async for chunk in stream:
+                text = chunk.choices[0].delta.content if chunk.choices else None
+                usage = None
+                if chunk.usage:
+                    usage = Usage(
+                        chunk.usage.prompt_tokens, chunk.usage.completion_tokens
+                    )
+                if text or usage:
+                    yield Completion(text or "", usage)
+        finally:
+            await stream.close()
+
+    async def close(self):
+        await self.client.close()
+
+
+# Answers of the local backend by prompt type, "{n}" is the number of the query
+LOCAL_TEMPLATES = {
+    "challenge": "Testfrage {n}: Welcher Tag ist heute?",
+    "too_early": "Zu früh! Das kostet dich einen Punkt, Antwort {n}.",
+    "success": "Glückwunsch zum Punkt! Alle anderen waren zu langsam, Antwort {n}.",
+    "lost": "Ihr habt 13:37 verpasst, der Punkt gehört mir, Antwort {n}.",
+    "challenge_won": "Richtig beantwortet! Ein Fun-Fact zur Frage folgt hier, Antwort {n}.",
+    "challenge_lost": "Leider falsch, der Punkt gehört mir, Antwort {n}.",
+}
+
+
+class LocalBackend(Backend):
+    """
+    Answers every query with the next text scripted for its prompt type, or
+    else with its template. The judge finds every answer wrong unless a script
+    says otherwise. A query takes ``latency`` seconds on average, varied by up
+    to half of that, and fails with a probability of ``error_rate``. Streams
+    yield a word every ``chunk_delay`` seconds after the first one. The same
+    seed gives the same latencies and errors for the same queries.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        chunk_delay: float = 0.0,
+        error_rate: float = 0.0,
+        script: dict[str, list[str]] | None = None,
+        seed: int = 0,
+    ):
+        self.latency = latency
+        self.chunk_delay = chunk_delay
+        self.error_rate = error_rate
+        self.script = {
+            prompt_type: list(texts) for prompt_type, texts in (script or {}).items()
+        }
+        self.random = random.Random(seed)
+        self.queries = count(1)
+
+    @classmethod
+    def from_env(cls) -> "LocalBackend":
+        script = None
+        if path := os.environ.get("AI_LOCAL_SCRIPT"):
+            with open(path) as f:
+                script = json.load(f)
+        return cls(
+            latency=float(os.environ.get("AI_LOCAL_LATENCY", 1)),
+            chunk_delay=float(os.environ.get("AI_LOCAL_CHUNK_DELAY", 0.05)),
+            error_rate=float(os.environ.get("AI_LOCAL_ERROR_RATE", 0)),
+            script=script,
+            seed=int(os.environ.get("AI_LOCAL_SEED", 0)),
+        )
+
+    def _answer(self, messages: list[dict], prompt_type: str) -> str:
+        n = next(self.queries)
+        if self.script.get(prompt_type):
+            texts = self.script[prompt_type]
+            # The last text is repeated once the script ran out
+            return texts.pop(0) if len(texts) > 1 else texts[0]
+        if prompt_type == "judge":
+            answers = re.findall(r"^(\d+)\. ", messages[-1]["content"], re.M)
+            return "\n".join(f"{i}. Falsch" for i in answers) or "Falsch"
+        return LOCAL_TEMPLATES.get(prompt_type, "Antwort {n}").format(n=n)
+
+    async def _wait(self):
+        delay = self.latency * self.random.uniform(0.5, 1.5)
+        failed = self.random.random() < self.error_rate
+        await asyncio.sleep(delay)
+        if failed:
+            raise BackendError("Injected error of the local AI backend")
+
+    @staticmethod
+    def _usage(messages: list[dict], text: str) -> Usage:
+        # Roughly like OpenAI's tokenizer for German text
+        prompt = sum(len(message["content"]) for message in messages)
+        return Usage(-(-prompt // 3), -(-len(text) // 3))
+
+    async def complete(self, messages: list[dict], prompt_type: str) -> Completion:
+        text = self._answer(messages, prompt_type)
+        await self._wait()
+        return Completion(text, self._usage(messages, text))
+
+    async def stream(
+        self, messages: list[dict], prompt_type: str
+    ) -> AsyncIterator[Completion]:
+        text = self._answer(messages, prompt_type)
+        await self._wait()
+        words = re.findall(r"\s*\S+", text)
+        for i, word in enumerate(words):
+            if i:
+                await asyncio.sleep(self.chunk_delay)
+            yield Completion(word)
+        yield Completion("", self._usage(messages, text))
+
+
+def create_backend(name: str) -> Backend | None:
+    """
+    The backend called ``name``, or None if it isn't configured.
+    """
+    if name == "openai":
+        api_key = os.environ.get("OPENAI_API_KEY")
+        return OpenAIBackend(api_key) if api_key else None
+    if name == "local":
+        return LocalBackend.from_env()
+    raise ValueError(f"Unknown AI backend {name!r}, use openai or local")
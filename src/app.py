@@ -7,15 +7,22 @@ from telegram.ext import (
     CommandHandler,
     CallbackQueryHandler,
     Application,
+    ApplicationBuilder,
     filters,
     ExtBot,
 )
 from telegram import BotCommand
+from prometheus_client import start_http_server
 
 import logging
 
+import ai
 import constants
 import handlers
+import metrics
+import migrations
+from outbox import outbox
+from update_processor import ChatOrderedUpdateProcessor
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
@@ -42,6 +49,16 @@ COMMANDS = [
         "description": "Prints the scores of everyone",
         "handler": handlers.score_command,
     },
+    {
+        "command": "stats",
+        "description": "Prints wins, streaks and monthly totals of this group",
+        "handler": handlers.stats_command,
+    },
+    {
+        "command": "leaderboard",
+        "description": "Prints the best players of all groups",
+        "handler": handlers.leaderboard_command,
+    },
     {
         "command": "clock",
         "description": "Outputs the date of the received message",
@@ -78,6 +95,19 @@ COMMANDS = [
 
 async def post_init(app: Application) -> None:
     app.bot: ExtBot
+    await migrations.run(app.bot.id)
+    handlers.debug_log_handler.start(app.bot)
+    await handlers.restore_challenges(app.job_queue)
+    app.job_queue.run_repeating(
+        handlers.question_pool_callback,
+        interval=int(os.environ.get("CHALLENGE_POOL_INTERVAL", 3600)),
+        first=60,
+    )
+    app.job_queue.run_repeating(
+        handlers.group_cleanup_callback,
+        interval=int(os.environ.get("GROUP_CLEANUP_INTERVAL", 3600)),
+        first=30,
+    )
     await app.bot.set_my_commands(
         [BotCommand(command["command"], command["description"]) for command in COMMANDS]
     )
@@ -94,37 +124,90 @@ async def post_init(app: Application) -> None:
         )
 
 
-def main():
-    if not (token := os.environ.get("TELEGRAM_TOKEN")):
-        logger.error('You need to set the environment variable "TELEGRAM_TOKEN"')
-        return sys.exit(-1)
+async def post_shutdown(app: Application) -> None:
+    await handlers.debug_log_handler.stop()
+    await outbox.stop()
+    await ai.close()
 
-    builder = Application.builder().token(token)
+
+def build_application(builder: ApplicationBuilder) -> Application:
+    """
+    Sets up the application for both polling and webhook mode.
+    """
     builder.post_init(post_init)
+    builder.post_shutdown(post_shutdown)
     app = builder.build()
 
+    timed = metrics.timed_handler
     app.add_handlers(
-        [CommandHandler(command["command"], command["handler"]) for command in COMMANDS]
+        [
+            CommandHandler(command["command"], timed(command["handler"]))
+            for command in COMMANDS
+        ]
     )
-    app.add_handler(CallbackQueryHandler(handlers.inlinebutton_click))
+    if constants.ADMIN_USER_ID:
+        # Not part of COMMANDS, so it isn't advertised to everyone
+        app.add_handler(
+            CommandHandler(
+                "leaderboard_admin",
+                timed(handlers.admin_leaderboard_command),
+                filters.User(constants.ADMIN_USER_ID),
+            )
+        )
+    app.add_handler(CallbackQueryHandler(timed(handlers.inlinebutton_click)))
     app.add_handler(
-        MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, handlers.added_to_group)
+        MessageHandler(
+            filters.StatusUpdate.NEW_CHAT_MEMBERS, timed(handlers.added_to_group)
+        )
     )
     app.add_handler(
         MessageHandler(
-            filters.StatusUpdate.LEFT_CHAT_MEMBER, handlers.removed_from_group
+            filters.StatusUpdate.LEFT_CHAT_MEMBER, timed(handlers.removed_from_group)
         )
     )
     app.add_handler(
         MessageHandler(
             filters.ChatType.GROUPS
             & (filters.TEXT | filters.Sticker.ALL | filters.ATTACHMENT),
-            handlers.group_chat_message,
+            timed(handlers.group_chat_message),
+        )
+    )
+    return app
+
+
+def main():
+    if not (token := os.environ.get("TELEGRAM_TOKEN")):
+        logger.error('You need to set the environment variable "TELEGRAM_TOKEN"')
+        return sys.exit(-1)
+
+    if metrics_port := os.environ.get("METRICS_PORT", "9090"):
+        start_http_server(int(metrics_port))
+        logger.info(f"Serving metrics on port {metrics_port}")
+
+    app = build_application(
+        Application.builder()
+        .token(token)
+        .request(metrics.InstrumentedRequest(connection_pool_size=256))
+        .concurrent_updates(
+            ChatOrderedUpdateProcessor(
+                int(os.environ.get("MAX_CONCURRENT_UPDATES", 32))
+            )
         )
     )
 
-    logger.info("Ready")
-    app.run_polling()
+    if webhook_url := os.environ.get("WEBHOOK_URL"):
+        logger.info(f"Ready, receiving updates via {webhook_url}")
+        app.run_webhook(
+            listen=os.environ.get("WEBHOOK_LISTEN", "0.0.0.0"),
+            port=int(os.environ.get("WEBHOOK_PORT", 8443)),
+            url_path=os.environ.get("WEBHOOK_PATH", "telegram"),
+            webhook_url=webhook_url,
+            secret_token=os.environ.get("WEBHOOK_SECRET_TOKEN"),
+            max_connections=int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", 40)),
+        )
+    else:
+        logger.info("Ready")
+        app.run_polling()
 
 
 if __name__ == "__main__":
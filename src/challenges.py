@@ -0,0 +1,106 @@
+"""
+Persistence of scheduled challenges. Pending challenges are kept in the
+``challenges:pending`` sorted set, chat id scored by the due UTC timestamp,
+so all of them are restored after a restart with a single range query.
+
+Questions are generated ahead of time into ``challenges:pool:{date}`` lists,
+one question per challenge due on that (UTC) date, so a challenge can be
+posted at 13:37 without waiting for OpenAI.
+"""
+
+import asyncio
+import logging
+import os
+from collections import Counter
+from datetime import date, datetime, timedelta
+
+import pytz
+
+import ai
+import metrics
+from db import redis
+
+logger = logging.getLogger(__name__)
+
+PENDING_CHALLENGES_KEY = "challenges:pending"
+POOL_LOOKAHEAD = timedelta(hours=int(os.environ.get("CHALLENGE_POOL_LOOKAHEAD", 36)))
+POOL_CONCURRENCY = int(os.environ.get("CHALLENGE_POOL_CONCURRENCY", 2))
+POOL_TTL = timedelta(days=2)
+
+
+async def add_pending_challenge(chat_id: int, due: float):
+    await redis.zadd(PENDING_CHALLENGES_KEY, {chat_id: due})
+
+
+async def remove_pending_challenge(chat_id: int):
+    await redis.zrem(PENDING_CHALLENGES_KEY, chat_id)
+
+
+async def get_pending_challenges() -> list[tuple[int, float]]:
+    return [
+        (int(chat_id), due)
+        for chat_id, due in await redis.zrange(
+            PENDING_CHALLENGES_KEY, 0, -1, withscores=True
+        )
+    ]
+
+
+def question_pool_key(day: date) -> str:
+    return f"challenges:pool:{day.isoformat()}"
+
+
+async def pop_pooled_question(day: date) -> str | None:
+    question = await redis.lpop(question_pool_key(day))
+    if question is None:
+        metrics.CHALLENGE_POOL_MISSES.inc()
+    else:
+        metrics.CHALLENGE_POOL_HITS.inc()
+    return question
+
+
+async def fill_question_pools():
+    """
+    Generates a question for every pending challenge that is due within
+    POOL_LOOKAHEAD and has none waiting in the pool of its date yet.
+    """
+    if ai.get_backend() is None:
+        return
+    now = datetime.now(pytz.utc)
+    pending = await redis.zrangebyscore(
+        PENDING_CHALLENGES_KEY,
+        now.timestamp(),
+        (now + POOL_LOOKAHEAD).timestamp(),
+        withscores=True,
+    )
+    demand = Counter(datetime.fromtimestamp(due, pytz.utc).date() for _, due in pending)
+    pipe = redis.pipeline()
+    for day in demand:
+        pipe.llen(question_pool_key(day))
+    backlog = {
+        day: needed - available
+        for (day, needed), available in zip(demand.items(), await pipe.execute())
+        if needed > available
+    }
+    metrics.CHALLENGE_POOL_BACKLOG.set(sum(backlog.values()))
+    if not backlog:
+        return
+    logger.info(f"Generating challenge questions: {backlog}")
+
+    semaphore = asyncio.Semaphore(POOL_CONCURRENCY)
+
+    async def generate(day: date):
+        async with semaphore:
+            question = await ai.get_challenge_message(day)
+        pipe = redis.pipeline()
+        pipe.rpush(question_pool_key(day), question)
+        pipe.expire(question_pool_key(day), POOL_TTL)
+        await pipe.execute()
+        metrics.CHALLENGE_POOL_BACKLOG.dec()
+
+    results = await asyncio.gather(
+        *[generate(day) for day, n in backlog.items() for _ in range(n)],
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logger.warning(f"Could not generate challenge question: {result!r}")
@@ -0,0 +1,124 @@
+"""
+Removal of group data after the bot left a group. Everything the bot stores
+per group lives in the keys listed in ``GROUP_KEYS``, so they are dropped
+right away with a single ``UNLINK``.
+
+Keys of older versions of the bot can't be listed that way. The group is
+remembered in ``cleanup:groups:removed`` and a background pass scans the
+keyspace for them. A pass works on a snapshot of the removed groups,
+``cleanup:groups:running``, and saves its cursor in the
+``cleanup:groups:progress`` hash after every batch, so it continues where it
+stopped when the bot is restarted.
+"""
+
+import asyncio
+import logging
+import os
+
+import metrics
+from db import redis
+from state import invalidate_group_state
+from utils import (
+    GROUP_TITLES_KEY,
+    LEADERBOARD_GROUPS_KEY,
+    LEADERBOARD_USERS_KEY,
+    invalidate_scoreboards,
+)
+
+logger = logging.getLogger(__name__)
+
+# Suffixes of all keys in use for a group, ``group:{chat_id}:<suffix>``
+GROUP_KEYS = ("scores", "state", "events", "stats")
+
+REMOVED_GROUPS_KEY = "cleanup:groups:removed"
+RUNNING_GROUPS_KEY = "cleanup:groups:running"
+PROGRESS_KEY = "cleanup:groups:progress"
+SCAN_COUNT = int(os.environ.get("GROUP_CLEANUP_SCAN_COUNT", 1000))
+
+_lock = asyncio.Lock()
+
+
+def group_keys(chat_id: int) -> list[str]:
+    return [f"group:{chat_id}:{suffix}" for suffix in GROUP_KEYS]
+
+
+async def drop_group(chat_id: int, bot_id: int | None):
+    """
+    Removes the group and takes the points its players made in it off the
+    leaderboard, like a rebuild of the leaderboard would.
+    """
+    scores = await redis.zrange(f"group:{chat_id}:scores", 0, -1, withscores=True)
+    players = [(user_id, n) for user_id, n in scores if user_id != str(bot_id)]
+    pipe = redis.pipeline()
+    for user_id, n in players:
+        pipe.zincrby(LEADERBOARD_USERS_KEY, -n, user_id)
+    pipe.unlink(*group_keys(chat_id))
+    pipe.sadd(REMOVED_GROUPS_KEY, chat_id)
+    pipe.zrem(LEADERBOARD_GROUPS_KEY, chat_id)
+    pipe.hdel(GROUP_TITLES_KEY, chat_id)
+    totals = (await pipe.execute())[: len(players)]
+    # Players left without any points most likely only played in this group
+    if gone := [user_id for (user_id, _), total in zip(players, totals) if not total]:
+        await redis.zrem(LEADERBOARD_USERS_KEY, *gone)
+    invalidate_group_state(chat_id)
+    invalidate_scoreboards(chat_id)
+
+
+async def cancel_group_cleanup(chat_id: int):
+    """
+    Keeps the keys of a group the bot was added to again.
+    """
+    pipe = redis.pipeline()
+    pipe.srem(REMOVED_GROUPS_KEY, chat_id)
+    pipe.srem(RUNNING_GROUPS_KEY, chat_id)
+    await pipe.execute()
+
+
+async def cleanup_removed_groups() -> int:
+    """
+    Deletes the remaining keys of removed groups, returns the number of keys.
+    Does nothing if a cleanup is already running.
+    """
+    if _lock.locked():
+        return 0
+    async with _lock:
+        unlinked = 0
+        while True:
+            if not await redis.exists(RUNNING_GROUPS_KEY):
+                if not await redis.exists(REMOVED_GROUPS_KEY):
+                    return unlinked
+                pipe = redis.pipeline()
+                pipe.rename(REMOVED_GROUPS_KEY, RUNNING_GROUPS_KEY)
+                pipe.delete(PROGRESS_KEY)
+                await pipe.execute()
+            unlinked += await _cleanup_pass()
+
+
+async def _cleanup_pass() -> int:
+    progress = await redis.hgetall(PROGRESS_KEY)
+    cursor = int(progress.get("cursor", 0))
+    if cursor:
+        logger.info(f"Resuming group cleanup at cursor {cursor}")
+    unlinked = 0
+    while True:
+        chat_ids = await redis.smembers(RUNNING_GROUPS_KEY)
+        metrics.GROUP_CLEANUP_PENDING.set(len(chat_ids))
+        cursor, keys = await redis.scan(cursor, match="group:*", count=SCAN_COUNT)
+        keys = [key for key in keys if key.split(":")[1] in chat_ids]
+        pipe = redis.pipeline()
+        if keys:
+            pipe.unlink(*keys)
+        if cursor:
+            pipe.hset(PROGRESS_KEY, "cursor", cursor)
+            pipe.hincrby(PROGRESS_KEY, "unlinked", len(keys))
+        else:
+            pipe.delete(RUNNING_GROUPS_KEY, PROGRESS_KEY)
+        await pipe.execute()
+        unlinked += len(keys)
+        metrics.GROUP_CLEANUP_UNLINKED_KEYS.inc(len(keys))
+        logger.debug(f"Group cleanup removed {len(keys)} keys, cursor {cursor}")
+        if not cursor:
+            break
+    metrics.GROUP_CLEANUP_PENDING.set(0)
+    logger.info(f"Group cleanup of {len(chat_ids)} groups removed {unlinked} keys")
+    return unlinked
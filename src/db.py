@@ -1,10 +1,41 @@
 import os
 
-from redis import Redis
+from redis.asyncio import BlockingConnectionPool, Redis
+from redis.asyncio.client import Pipeline
 
-redis = Redis(
+from metrics import REDIS_COMMAND_LATENCY
+
+
+class InstrumentedPipeline(Pipeline):
+    async def execute(self, raise_on_error: bool = True):
+        with REDIS_COMMAND_LATENCY.labels("PIPELINE").time():
+            return await super().execute(raise_on_error)
+
+
+class InstrumentedRedis(Redis):
+    """
+    Observes the latency of every command, pipelines count as one round trip.
+    """
+
+    async def execute_command(self, *args, **options):
+        with REDIS_COMMAND_LATENCY.labels(str(args[0]).upper()).time():
+            return await super().execute_command(*args, **options)
+
+    def pipeline(
+        self, transaction: bool = True, shard_hint: str | None = None
+    ) -> InstrumentedPipeline:
+        return InstrumentedPipeline(
+            self.connection_pool, self.response_callbacks, transaction, shard_hint
+        )
+
+
+pool = BlockingConnectionPool(
     host=os.environ.get("REDIS_HOST", "redis"),
     port=os.environ.get("REDIS_PORT", 6379),
-    charset="utf-8",
+    max_connections=int(os.environ.get("REDIS_MAX_CONNECTIONS", 50)),
+    timeout=float(os.environ.get("REDIS_POOL_TIMEOUT", 5)),
+    encoding="utf-8",
     decode_responses=True,
 )
+
+redis = InstrumentedRedis(connection_pool=pool)
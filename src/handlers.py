@@ -1,7 +1,9 @@
 import asyncio
 import logging
-from datetime import timedelta, datetime
-from typing import List
+import os
+from contextlib import aclosing
+from datetime import date, timedelta, datetime, time
+from typing import Any, AsyncIterator, Coroutine, List
 
 import pytz
 from telegram import (
@@ -10,62 +12,79 @@ from telegram import (
     ReplyKeyboardRemove,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
+    Message,
     User,
 )
 from telegram.constants import ChatAction
-from telegram.ext import CallbackContext
+from telegram.ext import CallbackContext, JobQueue
 
 import ai
+import metrics
+from challenges import (
+    add_pending_challenge,
+    fill_question_pools,
+    get_pending_challenges,
+    pop_pooled_question,
+    remove_pending_challenge,
+)
+from cleanup import cancel_group_cleanup, cleanup_removed_groups, drop_group
 from constants import OPENAI_ENABLED_GROUPS
-from db import redis
+from logshipper import TelegramMessageLogHandler
+from outbox import Priority, outbox
+from timezones import (
+    REGIONS,
+    TIMEZONES_BY_REGION,
+    get_region_markup,
+    get_timezone,
+    get_timezone_markup,
+)
+from state import (
+    get_group_state,
+    get_settled_until,
+    set_group_state,
+    settle_group_day,
+)
 from utils import (
-    get_timezone_region_markup,
+    BOT_DAY,
+    CHALLENGE_LOST,
+    CHALLENGE_WON,
+    TOO_EARLY,
+    WIN,
+    award,
     build_chat_scores,
-    decrease_score,
-    increase_score,
+    build_leaderboard,
+    build_stats,
+    get_ranking,
 )
 
 logger = logging.getLogger(__name__)
 
+ANSWER_BATCH_WINDOW = float(os.environ.get("CHALLENGE_ANSWER_BATCH_WINDOW", 0.5))
+AI_REPLY_BUDGET = float(os.environ.get("AI_REPLY_BUDGET", 10))
+AI_STREAM_EDIT_INTERVAL = float(os.environ.get("AI_STREAM_EDIT_INTERVAL", 1))
+CHALLENGE_RETRY_DELAY = timedelta(
+    seconds=int(os.environ.get("CHALLENGE_RETRY_DELAY", 60))
+)
 
-class TelegramMessageLogHandler(logging.StreamHandler):
-    def __init__(self):
-        super().__init__()
-        self.loop = asyncio.get_event_loop()
-
-    def emit(self, record):
-        try:
-            chat_id = getattr(record, "chat_id")
-            if not chat_id:
-                return
-            if not redis.get(f"group:{chat_id}:settings:openai:debuglog"):
-                return
-            context: CallbackContext = getattr(record, "context")
-            self.loop.create_task(self._async_emit(record, context, chat_id))
-            # self.loop.run_until_complete(asyncio.gather(*asyncio.all_tasks(self.loop)))
-        except Exception:
-            self.handleError(record)
-
-    async def _async_emit(self, record, context: CallbackContext, chat_id: int):
-        await context.bot.send_message(
-            chat_id=chat_id, text=record.msg, parse_mode="HTML"
-        )
-
-    # def close(self) -> None:
-    #     self.loop.run_until_complete(asyncio.gather(*asyncio.all_tasks(self.loop)))
-    #     self.loop.close()
+# Answers waiting to be judged, with the challenge they were given for, and the
+# task judging them
+_pending_answers: dict[int, list[tuple[str, Update]]] = {}
+_answer_workers: dict[int, asyncio.Task] = {}
+# AI replies that are still being generated
+_ai_replies: set[asyncio.Task] = set()
 
 
-logging.getLogger("ai").addHandler(TelegramMessageLogHandler())
+debug_log_handler = TelegramMessageLogHandler()
+logging.getLogger("ai").addHandler(debug_log_handler)
 
 
 async def timezone_command(update: Update, context: CallbackContext):
-    continents = sorted(set([x.partition("/")[0] for x in pytz.common_timezones]))
-    current_timezone = redis.get(f"group:{update.message.chat_id}:settings:timezone")
-    reply = get_timezone_region_markup(continents)
-    await context.bot.send_message(
-        chat_id=update.message.chat_id,
-        text=f'Your current timezone is set to "{current_timezone}". '
+    current_timezone = (await get_group_state(update.message.chat_id)).get("timezone")
+    reply = get_region_markup()
+    outbox.send_message(
+        context.bot,
+        update.message.chat_id,
+        f'Your current timezone is set to "{current_timezone}". '
         "If you want to change it, choose your region",
         reply_markup=reply,
     )
@@ -84,35 +103,74 @@ async def inlinebutton_click(update: Update, context: CallbackContext):
 
 
 async def score_command(update: Update, context: CallbackContext):
-    await context.bot.send_message(
-        chat_id=update.message.chat_id, text=build_chat_scores(update.message.chat_id)
+    outbox.send_message(
+        context.bot,
+        update.message.chat_id,
+        await build_chat_scores(update.message.chat_id),
+    )
+
+
+async def stats_command(update: Update, context: CallbackContext):
+    chat_id = update.message.chat_id
+    outbox.send_message(
+        context.bot,
+        chat_id,
+        await build_stats(chat_id, date.fromisoformat(await _local_day(update))),
+    )
+
+
+async def _local_day(update: Update) -> str:
+    """
+    Date of the message in the timezone of the group.
+    """
+    timezone = (await get_group_state(update.message.chat_id)).get("timezone")
+    tz = pytz.timezone(timezone) if timezone else pytz.utc
+    return update.message.date.astimezone(tz).strftime("%Y-%m-%d")
+
+
+async def leaderboard_command(update: Update, context: CallbackContext):
+    chat_id = update.message.chat_id
+    outbox.send_message(
+        context.bot, chat_id, await build_leaderboard(chat_id if chat_id < 0 else None)
+    )
+
+
+async def admin_leaderboard_command(update: Update, context: CallbackContext):
+    size = int(context.args[0]) if context.args and context.args[0].isdigit() else 25
+    outbox.send_message(
+        context.bot,
+        update.message.chat_id,
+        await build_leaderboard(size=size, show_groups=True),
     )
 
 
 async def clock_command(update: Update, context: CallbackContext):
     chat_id = update.message.chat_id
-    current_timezone = redis.get(f"group:{chat_id}:settings:timezone")
+    current_timezone = (await get_group_state(chat_id)).get("timezone")
     if not current_timezone:
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text="Sorry to interrupt you, but you need to set a /timezone",
+        outbox.send_message(
+            context.bot,
+            chat_id,
+            "Sorry to interrupt you, but you need to set a /timezone",
         )
         return
     tz = pytz.timezone(current_timezone)
     msg_sent_date = update.message.date.astimezone(tz)
-    await context.bot.send_message(
-        chat_id=update.message.chat_id,
-        text=f"I received your message at {msg_sent_date}",
+    outbox.send_message(
+        context.bot,
+        update.message.chat_id,
+        f"I received your message at {msg_sent_date}",
     )
 
 
 async def my_id_command(update: Update, context: CallbackContext):
-    await context.bot.send_message(
-        chat_id=update.message.chat_id,
-        text="\n".join(
+    outbox.send_message(
+        context.bot,
+        update.message.chat_id,
+        "\n".join(
             [
-                f"set group:{update.message.chat_id}:score:{update.message.from_user.id} X",
-                f'set user:{update.message.from_user.id}:name "{update.message.from_user.first_name}"',
+                f"zadd group:{update.message.chat_id}:scores X {update.message.from_user.id}",
+                f'hset user:names {update.message.from_user.id} "{update.message.from_user.first_name}"',
             ]
         ),
     )
@@ -122,25 +180,30 @@ async def added_to_group(update: Update, context: CallbackContext):
     for member in update.message.new_chat_members:
         if member["id"] == context.bot.id:
             logger.info(f"Added to group {update.message.chat}")
-            await update.message.reply_text(
-                "Hi! Would you mind telling me your /timezone?"
+            await cancel_group_cleanup(update.message.chat_id)
+            outbox.send_message(
+                context.bot,
+                update.message.chat_id,
+                "Hi! Would you mind telling me your /timezone?",
             )
     if update.message.chat_id in OPENAI_ENABLED_GROUPS:
-        redis.set(f"group:{update.message.chat_id}:settings:openai", "1")
+        await set_group_state(update.message.chat_id, openai="1")
 
 
 async def removed_from_group(update: Update, context: CallbackContext):
     if update.message.left_chat_member["id"] == context.bot.id:
         logger.info(f"Removed from group {update.message.chat}")
-        for key in redis.scan_iter(f"group:{update.message.chat_id}:*"):
-            logger.debug(f"Removing from redis: {key}")
-            redis.delete(key)
+        cancel_challenge(context.job_queue, update.message.chat_id)
+        await remove_pending_challenge(update.message.chat_id)
+        await drop_group(update.message.chat_id, context.bot.id)
+        context.job_queue.run_once(group_cleanup_callback, 0)
 
 
 async def start_command(update: Update, context: CallbackContext):
-    await context.bot.send_message(
-        chat_id=update.message.chat_id,
-        text="Hi there! I'll check the 13:37 score in a group chat. "
+    outbox.send_message(
+        context.bot,
+        update.message.chat_id,
+        "Hi there! I'll check the 13:37 score in a group chat. "
         "Just add me to a group, and when the clock says "
         "13:37, be the first to write something in the group!",
         reply_markup=ReplyKeyboardRemove(),
@@ -149,39 +212,90 @@ async def start_command(update: Update, context: CallbackContext):
     # "Make me an admin of the group to allow me to do that.")
 
 
-async def challenge_callback(context: CallbackContext):
-    chat_id = context.job.chat_id
-    # data = context.job.data
-    await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-    challenge = ai.get_challenge_message(
-        logger_extra={"context": context, "chat_id": chat_id}
-    )
-    redis.set(f"group:{chat_id}:last_challenge", challenge)
-    await context.bot.send_message(
+def cancel_challenge(job_queue: JobQueue, chat_id: int):
+    for job in job_queue.get_jobs_by_name(f"challenge_{chat_id}"):
+        job.schedule_removal()
+
+
+def schedule_challenge(job_queue: JobQueue, chat_id: int, due: datetime):
+    cancel_challenge(job_queue, chat_id)
+    job_queue.run_once(
+        challenge_callback,
+        due,
         chat_id=chat_id,
-        text=challenge,
+        name=f"challenge_{chat_id}",
+        data={"due": due.timestamp()},
+        # Overdue challenges restored on startup only run once the scheduler
+        # started, they must not be dropped as missed
+        job_kwargs={"misfire_grace_time": None},
     )
 
 
-async def challenge_command(update: Update, context: CallbackContext):
-    if not redis.get(f"group:{update.message.chat_id}:settings:openai"):
-        await context.bot.send_message(
-            chat_id=update.message.chat_id,
-            text="I'm sorry, but this feature is not available for this group.",
+async def restore_challenges(job_queue: JobQueue):
+    """
+    Reschedules the challenges that were pending when the bot was stopped.
+    Challenges that were due in the meantime are started right away.
+    """
+    now = datetime.now(pytz.utc)
+    pending = await get_pending_challenges()
+    for chat_id, due in pending:
+        schedule_challenge(
+            job_queue, chat_id, max(datetime.fromtimestamp(due, pytz.utc), now)
+        )
+    logger.info(f"Restored {len(pending)} pending challenges")
+
+
+async def challenge_callback(context: CallbackContext):
+    chat_id = context.job.chat_id
+    if context.job.data:
+        metrics.CHALLENGE_JOB_LAG.observe(
+            max(0.0, datetime.now(pytz.utc).timestamp() - context.job.data["due"])
+        )
+    # The challenge stays pending until it was started, so it is restored if
+    # the bot stops in the meantime
+    try:
+        challenge = await pop_pooled_question(datetime.now(pytz.utc).date())
+        if challenge is None:
+            outbox.send_chat_action(
+                context.bot, chat_id, ChatAction.TYPING, priority=Priority.GAME
+            )
+            challenge = await ai.get_challenge_message(
+                logger_extra={"context": context, "chat_id": chat_id}
+            )
+        await set_group_state(chat_id, last_challenge=challenge)
+    except Exception:
+        logger.exception(
+            f"Could not start the challenge in {chat_id}, "
+            f"retrying in {CHALLENGE_RETRY_DELAY}"
+        )
+        schedule_challenge(
+            context.job_queue, chat_id, datetime.now(pytz.utc) + CHALLENGE_RETRY_DELAY
         )
-        logger.info(f"Challenge not available for group {update.message.chat_id}")
         return
+    await remove_pending_challenge(chat_id)
+    outbox.send_message(context.bot, chat_id, challenge, priority=Priority.GAME)
+
+
+async def question_pool_callback(context: CallbackContext):
+    await fill_question_pools()
 
-    # cancel all previous jobs
-    for job in context.job_queue.get_jobs_by_name(
-        f"challenge_{update.message.chat_id}"
-    ):
-        job.schedule_removal()
 
-    redis.delete(f"group:{update.message.chat_id}:last_challenge")
+async def group_cleanup_callback(context: CallbackContext):
+    await cleanup_removed_groups()
 
-    timezone = redis.get(f"group:{update.message.chat_id}:settings:timezone")
-    tz = pytz.timezone(timezone)
+
+async def challenge_command(update: Update, context: CallbackContext):
+    group_state = await get_group_state(update.message.chat_id)
+    if not group_state.get("openai"):
+        outbox.send_message(
+            context.bot,
+            update.message.chat_id,
+            "I'm sorry, but this feature is not available for this group.",
+        )
+        logger.info(f"Challenge not available for group {update.message.chat_id}")
+        return
+
+    tz = pytz.timezone(group_state["timezone"])
     due = tz.localize(
         datetime.now().replace(hour=13, minute=37, second=0, microsecond=0)
     )
@@ -193,125 +307,327 @@ async def challenge_command(update: Update, context: CallbackContext):
     # Known downside: If you don't use the bot for multiple days and then start a challenge, the bot will
     # not notice that it earns points for the forgotten days. This would need to be checked here before the
     # "last_scored_day" is overwritten.
-    redis.set(
-        f"group:{update.message.chat_id}:last_scored_day",
-        due.strftime("%Y-%m-%d"),
+    await set_group_state(
+        update.message.chat_id,
+        last_challenge=None,
+        last_scored_day=due.strftime("%Y-%m-%d"),
     )
     chat_id = update.message.chat_id
-    context.job_queue.run_once(
-        challenge_callback,
-        due.astimezone(pytz.utc),
-        chat_id=chat_id,
-        name=f"challenge_{chat_id}",
-        # data="foobar",
-    )
-    await context.bot.send_message(
-        chat_id=update.message.chat_id,
-        text=(
-            f"Neue Challenge aktiviert. Ich melde mich wieder am {due.strftime('%d.%m.%Y um %H:%M:%S %Z')} "
-            "(falls ich zwischendurch nicht neugestartet werde)."
-        ),
+    schedule_challenge(context.job_queue, chat_id, due.astimezone(pytz.utc))
+    await add_pending_challenge(chat_id, due.timestamp())
+    outbox.send_message(
+        context.bot,
+        update.message.chat_id,
+        f"Neue Challenge aktiviert. Ich melde mich wieder am {due.strftime('%d.%m.%Y um %H:%M:%S %Z')}.",
     )
 
 
 async def autochallenge_command(update: Update, context: CallbackContext):
-    if not redis.get(f"group:{update.message.chat_id}:settings:openai"):
-        await context.bot.send_message(
-            chat_id=update.message.chat_id,
-            text="I'm sorry, but this feature is not available for this group.",
+    group_state = await get_group_state(update.message.chat_id)
+    if not group_state.get("openai"):
+        outbox.send_message(
+            context.bot,
+            update.message.chat_id,
+            "I'm sorry, but this feature is not available for this group.",
         )
         return
 
-    if redis.get(f"group:{update.message.chat_id}:autochallenge"):
-        redis.delete(f"group:{update.message.chat_id}:autochallenge")
-        await context.bot.send_message(
-            chat_id=update.message.chat_id,
-            text="Ich werde keine automatischen Challenges mehr starten.",
+    if group_state.get("autochallenge"):
+        await set_group_state(update.message.chat_id, autochallenge=None)
+        outbox.send_message(
+            context.bot,
+            update.message.chat_id,
+            "Ich werde keine automatischen Challenges mehr starten.",
         )
     else:
-        redis.set(f"group:{update.message.chat_id}:autochallenge", "1")
-        await context.bot.send_message(
-            chat_id=update.message.chat_id,
-            text="Ich werde automatisch eine neue Challenge starten, sobald die aktuelle gelöst wurde.",
+        await set_group_state(update.message.chat_id, autochallenge="1")
+        outbox.send_message(
+            context.bot,
+            update.message.chat_id,
+            "Ich werde automatisch eine neue Challenge starten, sobald die aktuelle gelöst wurde.",
         )
         await challenge_command(update, context)
 
 
 async def debuglog_command(update: Update, context: CallbackContext):
     chat_id = update.message.chat_id
-    if redis.get(f"group:{chat_id}:settings:openai:debuglog"):
-        redis.delete(f"group:{chat_id}:settings:openai:debuglog")
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text="Debug logging disabled",
-        )
+    if (await get_group_state(chat_id)).get("debuglog"):
+        await set_group_state(chat_id, debuglog=None)
+        outbox.send_message(context.bot, chat_id, "Debug logging disabled")
     else:
-        redis.set(f"group:{chat_id}:settings:openai:debuglog", "1")
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text="Debug logging enabled",
-        )
+        await set_group_state(chat_id, debuglog="1")
+        outbox.send_message(context.bot, chat_id, "Debug logging enabled")
 
 
 async def group_chat_message_with_challenges(
     challenge: str, update: Update, context: CallbackContext
 ):
-    user_answer = update.message.text
+    """
+    Queues the answer. Answers of a chat are judged in arrival order by a
+    single worker; everything that arrived while the previous batch was being
+    judged is judged together in one query. The first correct answer wins.
+    Only the scoring is done by the worker, the replies are generated in the
+    background.
+    """
     chat_id = update.message.chat_id
-    await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+    _pending_answers.setdefault(chat_id, []).append((challenge, update))
+    if chat_id not in _answer_workers:
+        _answer_workers[chat_id] = asyncio.create_task(_judge_answers(chat_id, context))
 
-    if ai.answer_is_correct(
-        challenge, user_answer, logger_extra={"context": context, "chat_id": chat_id}
-    ):
-        winner: User = update.message.from_user
-        increase_score(chat_id, winner)
-        redis.delete(f"group:{chat_id}:last_challenge")
-        await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-        message = ai.get_challenge_won_message(
-            bot_name=context.bot.first_name,
-            username=winner.first_name,
-            current_scores=build_chat_scores(chat_id, indent=2),
-            question=challenge,
-            answer=user_answer,
-            logger_extra={"context": context, "chat_id": chat_id},
-        )
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text=message,
+
+async def _judge_answers(chat_id: int, context: CallbackContext):
+    try:
+        while chat_id in _pending_answers:
+            outbox.send_chat_action(
+                context.bot, chat_id, ChatAction.TYPING, priority=Priority.GAME
+            )
+            await asyncio.sleep(ANSWER_BATCH_WINDOW)
+            answers = _pending_answers.pop(chat_id)
+            challenge = (await get_group_state(chat_id)).get("last_challenge")
+            # Answers to a challenge that was solved or replaced in the meantime
+            # are dropped
+            batch = [update for asked, update in answers if asked == challenge]
+            if not batch:
+                continue
+            verdicts = await ai.judge_answers(
+                challenge,
+                [update.message.text for update in batch],
+                logger_extra={"context": context, "chat_id": chat_id},
+            )
+            for update, correct in zip(batch, verdicts):
+                if correct is None:
+                    # No verdict, a glitch of the judge must not cost a point
+                    logger.warning(f"No verdict on an answer in {chat_id}")
+                    continue
+                if correct:
+                    await _challenge_won(challenge, update, context)
+                    break
+                await _challenge_lost(challenge, update, context)
+    except Exception:
+        logger.exception(f"Could not judge answers in {chat_id}")
+    finally:
+        _pending_answers.pop(chat_id, None)
+        del _answer_workers[chat_id]
+
+
+async def _challenge_won(challenge: str, update: Update, context: CallbackContext):
+    chat_id = update.message.chat_id
+    await award(
+        chat_id,
+        [(update.message.from_user, 1)],
+        chat_title=update.message.chat.title,
+        event=CHALLENGE_WON,
+        day=await _local_day(update),
+    )
+    await set_group_state(chat_id, last_challenge=None)
+    _in_background(update, context, _send_challenge_won(challenge, update, context))
+
+
+async def _send_challenge_won(challenge: str, update: Update, context: CallbackContext):
+    chat_id = update.message.chat_id
+    winner: User = update.message.from_user
+    outbox.send_chat_action(
+        context.bot, chat_id, ChatAction.TYPING, priority=Priority.GAME
+    )
+    try:
+        await _send_streamed(
+            context,
+            chat_id,
+            "challenge_won",
+            ai.stream_challenge_won_message(
+                bot_name=context.bot.first_name,
+                username=winner.first_name,
+                ranking=await get_ranking(chat_id),
+                question=challenge,
+                answer=update.message.text,
+                focus=(winner.id, context.bot.id),
+                logger_extra={"context": context, "chat_id": chat_id},
+            ),
+            f"Correct, {winner.first_name}! That's a point for you.",
         )
-        if redis.get(f"group:{chat_id}:autochallenge"):
+    finally:
+        if (await get_group_state(chat_id)).get("autochallenge"):
             await challenge_command(update, context)
-    else:
-        looser: User = update.message.from_user
-        decrease_score(chat_id, looser)
-        increase_score(chat_id, context.bot)
-        await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-        message = ai.get_challenge_lost_message(
+
+
+async def _challenge_lost(challenge: str, update: Update, context: CallbackContext):
+    await award(
+        update.message.chat_id,
+        [(update.message.from_user, -1), (context.bot, 1)],
+        chat_title=update.message.chat.title,
+        event=CHALLENGE_LOST,
+        day=await _local_day(update),
+    )
+    _in_background(update, context, _send_challenge_lost(challenge, update, context))
+
+
+async def _send_challenge_lost(
+    challenge: str, update: Update, context: CallbackContext
+):
+    chat_id = update.message.chat_id
+    looser: User = update.message.from_user
+    outbox.send_chat_action(
+        context.bot, chat_id, ChatAction.TYPING, priority=Priority.GAME
+    )
+    await _send_streamed(
+        context,
+        chat_id,
+        "challenge_lost",
+        ai.stream_challenge_lost_message(
             bot_name=context.bot.first_name,
             username=looser.first_name,
-            current_scores=build_chat_scores(chat_id, indent=2),
             question=challenge,
-            answer=user_answer,
+            answer=update.message.text,
             logger_extra={"context": context, "chat_id": chat_id},
+        ),
+        f"Wrong, {looser.first_name}. That's a point for me.",
+    )
+
+
+def _in_background(
+    update: Update, context: CallbackContext, reply: Coroutine[Any, Any, None]
+):
+    """
+    Sends a reply without making the caller wait for it to be generated.
+    """
+    task = context.application.create_task(reply, update=update)
+    _ai_replies.add(task)
+    task.add_done_callback(_ai_replies.discard)
+
+
+async def _send_streamed(
+    context: CallbackContext,
+    chat_id: int,
+    prompt_type: str,
+    chunks: AsyncIterator[str],
+    fallback: str,
+):
+    """
+    Shows a reply while it is generated: the first text is sent right away,
+    then the message is edited with the text so far, at most every
+    AI_STREAM_EDIT_INTERVAL seconds. Of the edits still waiting in the outbox
+    only the latest is sent. If the reply fails before any text arrived,
+    ``fallback`` is sent instead, otherwise the text so far is kept.
+    """
+    loop = asyncio.get_running_loop()
+    sent: asyncio.Future[Message] | None = None
+    text = shown = ""
+    shown_at = 0.0
+    try:
+        async with aclosing(chunks):
+            async for chunk in chunks:
+                text += chunk
+                if not text.strip() or loop.time() - shown_at < AI_STREAM_EDIT_INTERVAL:
+                    continue
+                sent = await _show_streamed(context, chat_id, prompt_type, sent, text)
+                shown, shown_at = text, loop.time()
+    except Exception:
+        logger.exception(f"Could not stream {prompt_type} reply to {chat_id}")
+        metrics.AI_REPLIES.labels(prompt_type, "failed").inc()
+        if not text.strip():
+            text = fallback
+    else:
+        metrics.AI_REPLIES.labels(prompt_type, "generated").inc()
+    if text.strip() and text != shown:
+        try:
+            await _show_streamed(context, chat_id, prompt_type, sent, text)
+        except Exception:
+            # The first message wasn't sent, the outbox has logged why
+            pass
+
+
+async def _show_streamed(
+    context: CallbackContext,
+    chat_id: int,
+    prompt_type: str,
+    sent: asyncio.Future[Message] | None,
+    text: str,
+) -> asyncio.Future[Message]:
+    if sent is None:
+        return outbox.send_message(
+            context.bot, chat_id, text, Priority.GAME, merge=False
         )
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text=message,
-        )
+    message = await sent
+    outbox.edit_message_text(
+        context.bot, chat_id, message.message_id, text, Priority.GAME
+    )
+    metrics.AI_STREAM_EDITS.labels(prompt_type).inc()
+    return sent
+
+
+def _reply_with_ai(
+    update: Update,
+    context: CallbackContext,
+    fallback: str,
+    prompt_type: str,
+    reply: Coroutine[Any, Any, str],
+):
+    """
+    Sends ``fallback`` right away and replaces it with the generated reply in
+    the background, if that arrives within AI_REPLY_BUDGET seconds.
+    """
+    chat_id = update.message.chat_id
+    sent = outbox.send_message(
+        context.bot, chat_id, fallback, Priority.GAME, merge=False
+    )
+    _in_background(
+        update,
+        context,
+        _replace_with_ai_reply(context, chat_id, sent, prompt_type, reply),
+    )
+
+
+async def _replace_with_ai_reply(
+    context: CallbackContext,
+    chat_id: int,
+    sent: asyncio.Future[Message],
+    prompt_type: str,
+    reply: Coroutine[Any, Any, str],
+):
+    if ai.get_backend() is None:
+        reply.close()
+        metrics.AI_REPLIES.labels(prompt_type, "unavailable").inc()
+        return
+    try:
+        text = await asyncio.wait_for(reply, AI_REPLY_BUDGET)
+    except asyncio.TimeoutError:
+        logger.warning(f"No {prompt_type} reply within {AI_REPLY_BUDGET}s")
+        metrics.AI_REPLIES.labels(prompt_type, "budget_exceeded").inc()
+        return
+    except Exception:
+        logger.exception(f"Could not generate {prompt_type} reply")
+        metrics.AI_REPLIES.labels(prompt_type, "failed").inc()
+        return
+    metrics.AI_REPLIES.labels(prompt_type, "generated").inc()
+    try:
+        message = await sent
+    except Exception:
+        # The fallback wasn't sent either, the outbox has logged why
+        return
+    outbox.edit_message_text(
+        context.bot, chat_id, message.message_id, text, Priority.GAME
+    )
 
 
 async def group_chat_message(update: Update, context: CallbackContext):
     chat_id: int = update.message.chat_id
-    current_timezone = redis.get(f"group:{chat_id}:settings:timezone")
+    metrics.GROUP_MESSAGES.inc()
+    if update.message.date.timestamp() < get_settled_until(chat_id):
+        metrics.SETTLED_DAY_MESSAGES.inc()
+        return
+
+    group_state = await get_group_state(chat_id)
+    current_timezone = group_state.get("timezone")
     if not current_timezone:
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text="Sorry to interrupt you, but you need to set a /timezone",
+        outbox.send_message(
+            context.bot,
+            chat_id,
+            "Sorry to interrupt you, but you need to set a /timezone",
         )
         return
 
     # check if a challenge is running
-    if challenge := redis.get(f"group:{chat_id}:last_challenge"):
+    if challenge := group_state.get("last_challenge"):
         await group_chat_message_with_challenges(challenge, update, context)
         return
 
@@ -321,7 +637,7 @@ async def group_chat_message(update: Update, context: CallbackContext):
 
     today = msg_sent_date.strftime("%Y-%m-%d")
     yesterday = (msg_sent_date - timedelta(days=1)).strftime("%Y-%m-%d")
-    last_scored_day = redis.get(f"group:{chat_id}:last_scored_day") or yesterday
+    last_scored_day = group_state.get("last_scored_day") or yesterday
     # last_scored_day = (msg_sent_date - timedelta(days=1)).strftime("%Y-%m-%d")  # DEBUG
     this_day = datetime.strptime(today, "%Y-%m-%d").astimezone(tz)
     last_day = datetime.strptime(last_scored_day, "%Y-%m-%d").astimezone(tz)
@@ -329,63 +645,72 @@ async def group_chat_message(update: Update, context: CallbackContext):
 
     if hour == 13 and minute == 36:
         looser: User = update.message.from_user
-        await decrease_score(chat_id, looser)
-        current_score = int(redis.get(f"group:{chat_id}:score:{looser.id}"))
-        await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-        if current_score >= 0 and redis.get(
-            f"group:{update.message.chat_id}:settings:openai"
-        ):
-            text = ai.get_too_early_message(
-                looser.first_name,
-                update.message.text,
-                current_score,
-                logger_extra={"context": context, "chat_id": chat_id},
+        (current_score,) = await award(
+            chat_id,
+            [(looser, -1)],
+            chat_title=update.message.chat.title,
+            event=TOO_EARLY,
+            day=today,
+        )
+        fallback = "That was too early. That's gonna cost you a point."
+        if current_score >= 0 and group_state.get("openai"):
+            _reply_with_ai(
+                update,
+                context,
+                fallback,
+                "too_early",
+                ai.get_too_early_message(
+                    context.bot.first_name,
+                    looser.first_name,
+                    update.message.text,
+                    current_score,
+                    logger_extra={"context": context, "chat_id": chat_id},
+                ),
             )
-            await context.bot.send_message(chat_id=chat_id, text=text)
         else:
-            await context.bot.send_message(
-                chat_id=chat_id,
-                text="That was too early. That's gonna cost you a point.",
-            )
+            outbox.send_message(context.bot, chat_id, fallback, priority=Priority.GAME)
 
     # elif delta.days >= 1:  # DEBUG
     elif hour == 13 and minute == 37 and delta.days >= 1:
         winner: User = update.message.from_user
-        increase_score(chat_id, winner)
-        redis.set(f"group:{chat_id}:last_scored_day", today)
-        if redis.get(f"group:{update.message.chat_id}:settings:openai"):
-            if delta.days > 1:
-                bot_wins_extra = delta.days - 1
-                increase_score(chat_id, context.bot, n=bot_wins_extra)
-            else:
-                bot_wins_extra = 0
-            await context.bot.send_chat_action(
-                chat_id=chat_id, action=ChatAction.TYPING
+        bot_wins_extra = delta.days - 1
+        points = [(winner, 1)]
+        if bot_wins_extra:
+            points.append((context.bot, bot_wins_extra))
+        await award(
+            chat_id,
+            points,
+            last_scored_day=today,
+            chat_title=update.message.chat.title,
+            event=WIN,
+        )
+        fallback = [f"Congratz, {winner.first_name}! Scores:"]
+        if bot_wins_extra:
+            n = bot_wins_extra
+            msg = "day" if n == 1 else f"{n} days"
+            fallback.append(
+                f"Wait a second. You forgot the last {msg}. So I'll get some points, too."
             )
-            text = ai.get_success_message(
-                context.bot.first_name,
-                winner.first_name,
-                update.message.text,
-                build_chat_scores(chat_id, indent=2),
-                bot_wins_extra=bot_wins_extra,
-                logger_extra={"context": context, "chat_id": chat_id},
+        fallback.append(await build_chat_scores(chat_id))
+        if group_state.get("openai"):
+            _reply_with_ai(
+                update,
+                context,
+                "\n\n".join(fallback),
+                "success",
+                ai.get_success_message(
+                    context.bot.first_name,
+                    winner.first_name,
+                    update.message.text,
+                    await get_ranking(chat_id),
+                    bot_wins_extra=bot_wins_extra,
+                    focus=(winner.id, context.bot.id),
+                    logger_extra={"context": context, "chat_id": chat_id},
+                ),
             )
-            await context.bot.send_message(chat_id=chat_id, text=text)
         else:
-            await context.bot.send_message(
-                chat_id=chat_id, text=f"Congratz, {winner.first_name}! Scores:"
-            )
-            if delta.days > 1:
-                n = delta.days - 1
-                msg = "day" if n == 1 else f"{n} days"
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=f"Wait a second. You forgot the last {msg}. So I'll get some points, too.",
-                )
-                increase_score(chat_id, context.bot, n=n)
-            await context.bot.send_message(
-                chat_id=chat_id, text=build_chat_scores(chat_id)
-            )
+            for text in fallback:
+                outbox.send_message(context.bot, chat_id, text, priority=Priority.GAME)
 
     elif (
         ((hour == 13 and minute > 37) or hour > 13)
@@ -396,95 +721,103 @@ async def group_chat_message(update: Update, context: CallbackContext):
         logger.info(f"Last scored day: {last_scored_day}")
         if (hour == 13 and minute > 37) or hour > 13:
             n = delta.days
-            redis.set(f"group:{chat_id}:last_scored_day", today)
+            scored_day = today
         else:
             n = delta.days - 1
-            redis.set(f"group:{chat_id}:last_scored_day", yesterday)
+            scored_day = yesterday
 
         logger.info(f"Bot gets {n} points")
-        increase_score(chat_id, context.bot, n=n)
-        logger.info("Sending message")
-        await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-        logger.info("Chat action sent")
-
-        if redis.get(f"group:{update.message.chat_id}:settings:openai"):
+        await award(
+            chat_id,
+            [(context.bot, n)],
+            last_scored_day=scored_day,
+            chat_title=update.message.chat.title,
+            event=BOT_DAY,
+        )
+        fallback = ["Oh dear. You forgot 13:37. Point for me"]
+        if n > 1:
+            fallback.append(f"You even forgot it for {n} days... I'm disappointed.")
+        fallback.append(await build_chat_scores(chat_id))
+        if group_state.get("openai"):
             logger.info("Using OpenAI")
-            text = ai.get_lost_message(
-                context.bot.first_name,
-                update.message.from_user.first_name,
-                update.message.text,
-                build_chat_scores(chat_id, indent=2),
-                n,
-                logger_extra={"context": context, "chat_id": chat_id},
+            _reply_with_ai(
+                update,
+                context,
+                "\n\n".join(fallback),
+                "lost",
+                ai.get_lost_message(
+                    context.bot.first_name,
+                    update.message.from_user.first_name,
+                    update.message.text,
+                    await get_ranking(chat_id),
+                    n,
+                    focus=(update.message.from_user.id, context.bot.id),
+                    logger_extra={"context": context, "chat_id": chat_id},
+                ),
             )
-            logger.info("Message generated")
-            await context.bot.send_message(chat_id=chat_id, text=text)
-            logger.info("Message sent")
         else:
-            await context.bot.send_message(
-                chat_id=chat_id, text="Oh dear. You forgot 13:37. Point for me"
-            )
+            for text in fallback:
+                outbox.send_message(context.bot, chat_id, text, priority=Priority.GAME)
 
-            if n > 1:
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=f"You even forgot it for {n} days... I'm disappointed.",
-                )
-            await context.bot.send_message(
-                chat_id=chat_id, text=build_chat_scores(chat_id)
+    else:
+        # Nothing can happen until the next 13:36, not even after midnight
+        next_check = tz.localize(datetime.combine(msg_sent_date.date(), time(13, 36)))
+        if next_check <= msg_sent_date:
+            next_check = tz.localize(
+                datetime.combine(msg_sent_date.date() + timedelta(days=1), time(13, 36))
             )
+        await settle_group_day(chat_id, int(next_check.timestamp()))
 
 
 async def _inlinebutton_timezone(
     update: Update, context: CallbackContext, query: CallbackQuery, args: List[str]
 ):
-    continents = sorted(set([x.partition("/")[0] for x in pytz.common_timezones]))
-    location = args[0]
-    if location == "region_selection":
-        reply = get_timezone_region_markup(continents)
-        await query.edit_message_text("Choose your region")
-        await query.edit_message_reply_markup(reply)
-    elif location in pytz.all_timezones:
-        redis.set(f"group:{query.message.chat_id}:settings:timezone", location)
-        tz = pytz.timezone(location)
-        local_time = query.message.date.astimezone(tz).strftime("%X")
-        reply = InlineKeyboardMarkup(
-            [
-                [
-                    (
-                        InlineKeyboardButton(
-                            "Change timezone", callback_data="timezone:region_selection"
-                        )
-                    )
-                ]
-            ]
+    # timezone:r:<region>:<page> shows a page of a region, timezone:z:<region>:<zone>
+    # selects a timezone. Plain names are sent by keyboards of older versions.
+    action, *indexes = args
+    if action == "r":
+        region_index, page = map(int, indexes)
+        await query.edit_message_text(
+            "Choose your timezone",
+            reply_markup=get_timezone_markup(region_index, page),
         )
+        return
+    if action == "z":
+        location = get_timezone(*map(int, indexes))
+    elif action in TIMEZONES_BY_REGION and TIMEZONES_BY_REGION[action] != [action]:
+        await query.edit_message_text(
+            "Choose your timezone",
+            reply_markup=get_timezone_markup(REGIONS.index(action), 0),
+        )
+        return
+    elif action in pytz.all_timezones_set:
+        location = action
+    else:
+        location = None
+
+    if location is None:
         await query.edit_message_text(
-            f"Timezone of this chat was set to {location}. "
-            f"Looks like it was {local_time} when you sent the last /timezone command. "
-            "If this is incorrect, please execute /timezone again or click the button below."
+            "Choose your region", reply_markup=get_region_markup()
         )
-        await query.edit_message_reply_markup(reply)
-    elif location in continents:
-        zones = [x for x in pytz.all_timezones if x.startswith(location)]
-        reply = InlineKeyboardMarkup(
+        return
+
+    await set_group_state(query.message.chat_id, timezone=location)
+    tz = pytz.timezone(location)
+    local_time = query.message.date.astimezone(tz).strftime("%X")
+    reply = InlineKeyboardMarkup(
+        [
             [
-                [
+                (
                     InlineKeyboardButton(
-                        x.partition("/")[2], callback_data=":".join(["timezone", x])
+                        "Change timezone", callback_data="timezone:region_selection"
                     )
-                ]
-                for x in zones
+                )
             ]
-            + [
-                [
-                    (
-                        InlineKeyboardButton(
-                            "« Back", callback_data="timezone:region_selection"
-                        )
-                    )
-                ]
-            ],
-        )
-        await query.edit_message_text("Choose your timezone")
-        await query.edit_message_reply_markup(reply)
+        ]
+    )
+    await query.edit_message_text(
+        f"Timezone of this chat was set to {location}. "
+        f"Looks like it was {local_time} when you sent the last /timezone command. "
+        "If this is incorrect, please execute /timezone again or click the button below.",
+        reply_markup=reply,
+    )
@@ -0,0 +1,127 @@
+"""
+Ships debug log records to the chat they belong to, if /debuglog is enabled
+there. ``emit`` only appends the record to a bounded queue, so logging never
+blocks or delays a handler. A background task coalesces the records of each
+chat over a short window and sends them in as few messages as Telegram allows.
+"""
+
+import asyncio
+import html
+import logging
+import os
+import re
+
+from telegram import Bot
+from telegram.constants import MessageLimit, ParseMode
+from telegram.error import TelegramError
+
+import metrics
+from outbox import Priority, outbox
+from state import get_group_state, peek_group_state
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = float(os.environ.get("DEBUG_LOG_FLUSH_INTERVAL", 2))
+QUEUE_SIZE = int(os.environ.get("DEBUG_LOG_QUEUE_SIZE", 1000))
+
+
+def split_message(text: str, limit: int = MessageLimit.MAX_TEXT_LENGTH) -> list[str]:
+    """
+    Splits a text into parts of at most ``limit`` characters, preferably at line breaks.
+    """
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    if text:
+        parts.append(text)
+    return parts
+
+
+def _strip_tags(text: str) -> str:
+    return html.unescape(re.sub(r"<[^>]+>", "", text))
+
+
+class TelegramMessageLogHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.queue: asyncio.Queue | None = None
+        self.bot: Bot | None = None
+        self.task: asyncio.Task | None = None
+
+    def start(self, bot: Bot):
+        self.bot = bot
+        self.queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    def emit(self, record):
+        try:
+            chat_id = getattr(record, "chat_id", None)
+            if not chat_id or self.queue is None:
+                return
+            # Skip chats known to have debug logging disabled without a lookup
+            state = peek_group_state(chat_id)
+            if state is not None and not state.get("debuglog"):
+                return
+            self.queue.put_nowait((chat_id, record.getMessage()))
+        except asyncio.QueueFull:
+            metrics.DEBUG_LOG_DROPPED.labels("queue_full").inc()
+        except Exception:
+            self.handleError(record)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            chat_id, text = await self.queue.get()
+            pending = {chat_id: [text]}
+            deadline = loop.time() + FLUSH_INTERVAL
+            while (timeout := deadline - loop.time()) > 0:
+                try:
+                    chat_id, text = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                pending.setdefault(chat_id, []).append(text)
+            for chat_id, texts in pending.items():
+                try:
+                    await self._send(chat_id, texts)
+                except Exception:
+                    logger.exception(f"Could not ship debug log to {chat_id}")
+
+    async def _send(self, chat_id: int, texts: list[str]):
+        if not (await get_group_state(chat_id)).get("debuglog"):
+            return
+        messages = []
+        for text in texts:
+            if len(text) > MessageLimit.MAX_TEXT_LENGTH:
+                # Tags would be torn apart, send oversized records as plain text
+                messages += [(part, None) for part in split_message(_strip_tags(text))]
+            elif (
+                messages
+                and messages[-1][1]
+                and len(messages[-1][0]) + len(text) + 2 <= MessageLimit.MAX_TEXT_LENGTH
+            ):
+                messages[-1] = (f"{messages[-1][0]}\n\n{text}", ParseMode.HTML)
+            else:
+                messages.append((text, ParseMode.HTML))
+        for text, parse_mode in messages:
+            try:
+                await outbox.send_message(
+                    self.bot,
+                    chat_id,
+                    text,
+                    priority=Priority.DEBUG,
+                    merge=False,
+                    parse_mode=parse_mode,
+                )
+            except TelegramError:
+                metrics.DEBUG_LOG_DROPPED.labels("send_failed").inc()
+            else:
+                metrics.DEBUG_LOG_MESSAGES.inc()
@@ -0,0 +1,136 @@
+import functools
+
+from prometheus_client import Counter, Gauge, Histogram
+from telegram.error import TelegramError
+from telegram.request import HTTPXRequest
+
+GROUP_MESSAGES = Counter("group_messages", "Messages received in group chats")
+SETTLED_DAY_MESSAGES = Counter(
+    "settled_day_messages",
+    "Group messages dismissed without any work because the day was already settled",
+)
+DEBUG_LOG_MESSAGES = Counter(
+    "debug_log_messages", "Telegram messages sent by the debug log shipper"
+)
+DEBUG_LOG_DROPPED = Counter(
+    "debug_log_dropped",
+    "Debug log records or messages that were dropped",
+    ["reason"],
+)
+CHALLENGE_POOL_HITS = Counter(
+    "challenge_pool_hits", "Challenges posted with a pre-generated question"
+)
+CHALLENGE_POOL_MISSES = Counter(
+    "challenge_pool_misses",
+    "Challenges that had to wait for a live query because the pool was empty",
+)
+CHALLENGE_POOL_BACKLOG = Gauge(
+    "challenge_pool_backlog", "Challenge questions that still need to be generated"
+)
+GROUP_CLEANUP_PENDING = Gauge(
+    "group_cleanup_pending", "Removed groups the running cleanup pass is looking for"
+)
+GROUP_CLEANUP_UNLINKED_KEYS = Counter(
+    "group_cleanup_unlinked_keys", "Leftover keys of removed groups that were deleted"
+)
+OUTBOX_QUEUED = Gauge("outbox_queued", "Messages and chat actions waiting to be sent")
+OUTBOX_MERGED = Counter(
+    "outbox_merged", "Texts appended to a message that was still waiting"
+)
+OUTBOX_DROPPED_ACTIONS = Counter(
+    "outbox_dropped_actions", "Chat actions that were redundant and not sent"
+)
+OUTBOX_RETRIES = Counter("outbox_retries", "Sends retried because of flood control")
+OUTBOX_FAILED = Counter(
+    "outbox_failed", "Messages and chat actions that could not be sent"
+)
+SCOREBOARD_CACHE_HITS = Counter(
+    "scoreboard_cache_hits", "Scoreboards served from the in-memory cache"
+)
+SCOREBOARD_CACHE_MISSES = Counter(
+    "scoreboard_cache_misses", "Scoreboards that had to be read from redis"
+)
+NAME_CACHE_MISSES = Counter(
+    "name_cache_misses", "User names that had to be read from redis"
+)
+AI_REPLIES = Counter(
+    "ai_replies",
+    "AI replies by outcome: generated, or why the fallback text was kept",
+    ["prompt_type", "outcome"],
+)
+AI_STREAM_EDITS = Counter(
+    "ai_stream_edits",
+    "Edits of a message to show more of a reply while it was generated",
+    ["prompt_type"],
+)
+
+HANDLER_LATENCY = Histogram(
+    "handler_latency_seconds", "Time spent in a Telegram update handler", ["handler"]
+)
+REDIS_COMMAND_LATENCY = Histogram(
+    "redis_command_latency_seconds",
+    "Redis round trips by command, pipelines are observed as a single PIPELINE",
+    ["command"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+OPENAI_QUERY_LATENCY = Histogram(
+    "openai_query_latency_seconds",
+    "Time until OpenAI answered a query",
+    ["prompt_type"],
+    buckets=(0.5, 1, 2, 3, 5, 7.5, 10, 15, 20, 30, 60),
+)
+OPENAI_FIRST_CHUNK_LATENCY = Histogram(
+    "openai_first_chunk_latency_seconds",
+    "Time until the first text of a streamed OpenAI completion arrived",
+    ["prompt_type"],
+    buckets=(0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 10),
+)
+OPENAI_PROMPT_TOKENS = Histogram(
+    "openai_prompt_tokens",
+    "Prompt tokens of a single OpenAI query",
+    ["prompt_type"],
+    buckets=(50, 100, 150, 200, 300, 400, 500, 750, 1000, 2000, 4000),
+)
+OPENAI_TOKENS = Counter(
+    "openai_tokens", "Tokens used by OpenAI queries", ["prompt_type", "kind"]
+)
+TELEGRAM_REQUEST_LATENCY = Histogram(
+    "telegram_request_latency_seconds", "Bot API request latency", ["method"]
+)
+TELEGRAM_REQUEST_ERRORS = Counter(
+    "telegram_request_errors", "Failed Bot API requests", ["method", "error"]
+)
+CHALLENGE_JOB_LAG = Histogram(
+    "challenge_job_lag_seconds",
+    "Delay between the scheduled time of a challenge and its job starting",
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300, 3600),
+)
+
+
+def timed_handler(callback):
+    """
+    Wraps an update handler callback to observe its latency.
+    """
+    histogram = HANDLER_LATENCY.labels(callback.__name__)
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        with histogram.time():
+            return await callback(update, context)
+
+    return wrapper
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """
+    Observes latency and errors of every Bot API method the bot calls.
+    """
+
+    async def post(self, url: str, *args, **kwargs):
+        method = url.rsplit("/", 1)[-1]
+        try:
+            with TELEGRAM_REQUEST_LATENCY.labels(method).time():
+                return await super().post(url, *args, **kwargs)
+        except TelegramError as e:
+            TELEGRAM_REQUEST_ERRORS.labels(method, type(e).__name__).inc()
+            raise
@@ -0,0 +1,165 @@
+"""
+One-shot conversions of the redis keyspace. Every migration is idempotent and
+is run on startup, so a deployment never has to be accompanied by manual steps.
+Completed migrations are recorded in ``migrations:done`` and skipped from then
+on, they scan the whole keyspace. Run ``python migrations.py`` to apply them
+without starting the bot.
+``python migrations.py --rebuild-leaderboards`` recomputes the global
+leaderboard from the group scores, stop the bot while it runs.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+
+from db import redis
+from state import group_state_key
+from utils import LEADERBOARD_GROUPS_KEY, LEADERBOARD_USERS_KEY
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 1000
+DONE_KEY = "migrations:done"
+
+
+async def _batched_scan(pattern: str):
+    batch = []
+    async for key in redis.scan_iter(pattern, count=BATCH_SIZE):
+        batch.append(key)
+        if len(batch) >= BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def migrate_score_keys() -> int:
+    """
+    Moves ``group:{chat_id}:score:{user_id}`` strings into the sorted set
+    ``group:{chat_id}:scores`` and ``user:{user_id}:name`` strings into the
+    ``user:names`` hash.
+    """
+    migrated = 0
+    async for keys in _batched_scan("group:*:score:*"):
+        values = await redis.mget(keys)
+        pipe = redis.pipeline()
+        for key, value in zip(keys, values):
+            if value is None:
+                continue
+            _, chat_id, _, user_id = key.split(":")
+            pipe.zincrby(f"group:{chat_id}:scores", int(value), user_id)
+            pipe.delete(key)
+            migrated += 1
+        await pipe.execute()
+    async for keys in _batched_scan("user:*:name"):
+        values = await redis.mget(keys)
+        pipe = redis.pipeline()
+        for key, value in zip(keys, values):
+            if value is None:
+                continue
+            user_id = key.split(":")[1]
+            pipe.hsetnx("user:names", user_id, value)
+            pipe.delete(key)
+        await pipe.execute()
+    if migrated:
+        logger.info(f"Migrated {migrated} score keys to sorted sets")
+    return migrated
+
+
+# Suffix of the old per-setting keys and the field of the group state hash they move to
+GROUP_STATE_KEYS = {
+    "settings:timezone": "timezone",
+    "settings:openai": "openai",
+    "settings:openai:debuglog": "debuglog",
+    "autochallenge": "autochallenge",
+    "last_challenge": "last_challenge",
+    "last_scored_day": "last_scored_day",
+}
+
+
+async def migrate_group_state_keys() -> int:
+    """
+    Moves the separate ``group:{chat_id}:<setting>`` strings into the
+    ``group:{chat_id}:state`` hash.
+    """
+    migrated = 0
+    async for keys in _batched_scan("group:*"):
+        keys = [key for key in keys if key.split(":", 2)[-1] in GROUP_STATE_KEYS]
+        if not keys:
+            continue
+        values = await redis.mget(keys)
+        pipe = redis.pipeline()
+        for key, value in zip(keys, values):
+            if value is None:
+                continue
+            _, chat_id, suffix = key.split(":", 2)
+            pipe.hsetnx(group_state_key(int(chat_id)), GROUP_STATE_KEYS[suffix], value)
+            pipe.delete(key)
+            migrated += 1
+        await pipe.execute()
+    if migrated:
+        logger.info(f"Migrated {migrated} settings keys to group state hashes")
+    return migrated
+
+
+async def rebuild_leaderboards(bot_id: int | None, force=False) -> int:
+    """
+    Sums up the scores of all groups into the leaderboard sorted sets. Only
+    runs once unless ``force`` is set, afterwards the leaderboard is kept up
+    to date by every award. Returns the number of groups.
+    """
+    if not force and await redis.exists(LEADERBOARD_GROUPS_KEY):
+        return 0
+    users_key = f"{LEADERBOARD_USERS_KEY}:rebuild"
+    groups_key = f"{LEADERBOARD_GROUPS_KEY}:rebuild"
+    await redis.delete(users_key, groups_key)
+    groups = 0
+    async for keys in _batched_scan("group:*:scores"):
+        pipe = redis.pipeline()
+        for key in keys:
+            pipe.zrange(key, 0, -1, withscores=True)
+        all_scores = await pipe.execute()
+        pipe = redis.pipeline()
+        for key, scores in zip(keys, all_scores):
+            scores = [(uid, n) for uid, n in scores if uid != str(bot_id)]
+            if not scores:
+                continue
+            for user_id, n in scores:
+                pipe.zincrby(users_key, n, user_id)
+            pipe.zadd(groups_key, {key.split(":")[1]: sum(n for _, n in scores)})
+            groups += 1
+        await pipe.execute()
+    pipe = redis.pipeline()
+    if groups:
+        pipe.rename(users_key, LEADERBOARD_USERS_KEY)
+        pipe.rename(groups_key, LEADERBOARD_GROUPS_KEY)
+    else:
+        pipe.delete(LEADERBOARD_USERS_KEY, LEADERBOARD_GROUPS_KEY)
+    await pipe.execute()
+    logger.info(f"Rebuilt the leaderboard from {groups} groups")
+    return groups
+
+
+async def _run_once(name: str, migration):
+    if await redis.sismember(DONE_KEY, name):
+        return
+    await migration()
+    await redis.sadd(DONE_KEY, name)
+
+
+async def run(bot_id: int | None = None, force_leaderboards=False):
+    await _run_once("score_keys", migrate_score_keys)
+    await _run_once("group_state_keys", migrate_group_state_keys)
+    await rebuild_leaderboards(bot_id, force=force_leaderboards)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rebuild-leaderboards", action="store_true")
+    args = parser.parse_args()
+    # The bot's id is the first part of its token
+    token_id = os.environ.get("TELEGRAM_TOKEN", "").split(":")[0]
+    bot_id = int(token_id) if token_id.isdigit() else None
+    asyncio.run(run(bot_id, args.rebuild_leaderboards))
@@ -0,0 +1,54 @@
+"""
+Registry of user names, the ``user:names`` hash of user id to first name. A
+bounded in-process copy of it decides whether a name has to be written at
+all, and serves most lookups without redis. Names are only written through
+``award``, which keeps the copy up to date.
+"""
+
+import os
+from collections import OrderedDict
+from typing import Iterable
+
+import metrics
+from db import redis
+
+NAMES_KEY = "user:names"
+CACHE_SIZE = int(os.environ.get("NAME_CACHE_SIZE", 10000))
+
+_cache: OrderedDict[str, str] = OrderedDict()
+
+
+def _remember(user_id: str, name: str):
+    _cache[user_id] = name
+    _cache.move_to_end(user_id)
+    if len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+
+
+def is_known(user_id: int, name: str) -> bool:
+    """
+    Whether ``name`` is already stored for the user.
+    """
+    return _cache.get(str(user_id)) == name
+
+
+def remember(user_id: int, name: str):
+    """
+    Records a name that was written to redis.
+    """
+    _remember(str(user_id), name)
+
+
+async def resolve(user_ids: Iterable[int | str]) -> list[str | None]:
+    """
+    Names of the given users in the same order, unknown users are ``None``.
+    All names missing from the cache are read with a single HMGET.
+    """
+    user_ids = [str(user_id) for user_id in user_ids]
+    missing = [user_id for user_id in user_ids if user_id not in _cache]
+    metrics.NAME_CACHE_MISSES.inc(len(missing))
+    if missing:
+        for user_id, name in zip(missing, await redis.hmget(NAMES_KEY, missing)):
+            if name is not None:
+                _remember(user_id, name)
+    return [_cache.get(user_id) for user_id in user_ids]
@@ -0,0 +1,382 @@
+"""
+Outgoing messages. Handlers put their messages into the outbox instead of
+waiting for the Bot API, a single worker sends them within Telegram's limits:
+
+- a global budget (``OUTBOX_RATE`` messages per second) and one per chat
+  (``OUTBOX_CHAT_RATE`` per second after a burst of ``OUTBOX_CHAT_BURST``)
+- chats are served by the priority of their next message, game results go
+  out before replies to commands and those before debug logs
+- the messages of one chat are always sent in order
+- consecutive texts for a chat that are still waiting are merged into one
+  message, a chat action is dropped if a message for the chat is waiting
+  anyway or the same action is still shown
+- a waiting edit of a message is replaced by a later edit of it
+- a ``RetryAfter`` puts the message back at the head of its chat, which is
+  paused for the requested time
+
+``send_message`` and ``edit_message_text`` return a future of the resulting
+``Message``, merged texts share it. Awaiting it is optional.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import timedelta
+from enum import IntEnum
+
+from telegram import Bot, Message
+from telegram.constants import MessageLimit
+from telegram.error import RetryAfter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+RATE = float(os.environ.get("OUTBOX_RATE", 25))
+CHAT_RATE = float(os.environ.get("OUTBOX_CHAT_RATE", 1 / 3))
+CHAT_BURST = float(os.environ.get("OUTBOX_CHAT_BURST", 3))
+# Seconds Telegram shows a chat action, unless a message is sent before
+CHAT_ACTION_DURATION = 5
+
+
+class Priority(IntEnum):
+    GAME = 0
+    DEFAULT = 1
+    DEBUG = 2
+
+
+class TokenBucket:
+    """
+    Allows ``rate`` sends per second after a burst of ``capacity``. A rate of
+    0 disables the limit.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def delay(self, now: float) -> float:
+        """
+        Seconds until the next send is allowed.
+        """
+        if not self.rate:
+            return 0
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def take(self):
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        return not self.rate or self.delay(now) == 0 and self.tokens >= self.capacity
+
+
+@dataclass
+class _Item:
+    bot: Bot
+    chat_id: int
+    priority: Priority
+    seq: int
+    text: str | None = None
+    action: str | None = None
+    # Set for edits of this message
+    message_id: int | None = None
+    kwargs: dict = field(default_factory=dict)
+    mergeable: bool = False
+    futures: list[asyncio.Future] = field(default_factory=list)
+
+
+def _retrieve_exception(future: asyncio.Future):
+    # Failures are logged by the worker, nobody has to await the future
+    if not future.cancelled():
+        future.exception()
+
+
+class Outbox:
+    def __init__(
+        self,
+        rate: float = RATE,
+        chat_rate: float = CHAT_RATE,
+        chat_burst: float = CHAT_BURST,
+    ):
+        self.rate = rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._worker: asyncio.Task | None = None
+
+    def _reset(self):
+        self._loop = asyncio.get_running_loop()
+        self._seq = itertools.count()
+        self._queues: dict[int, deque[_Item]] = {}
+        self._buckets: dict[int, TokenBucket] = {}
+        self._last_action: dict[int, tuple[str, float]] = {}
+        self._global = TokenBucket(self.rate, max(1.0, self.rate))
+        # Heaps of (priority, seq, chat_id) and (time, priority, seq, chat_id),
+        # each chat with waiting messages that isn't sending is in one of them
+        self._ready: list[tuple[int, int, int]] = []
+        self._paused: list[tuple[float, int, int, int]] = []
+        self._scheduled: set[int] = set()
+        self._sending: dict[int, asyncio.Task] = {}
+        self._wakeup = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._worker = asyncio.create_task(self._run())
+
+    def _ensure_worker(self):
+        if (
+            self._worker is None
+            or self._worker.done()
+            or self._loop is not asyncio.get_running_loop()
+        ):
+            self._reset()
+
+    def send_message(
+        self,
+        bot: Bot,
+        chat_id: int,
+        text: str,
+        priority: Priority = Priority.DEFAULT,
+        merge: bool = True,
+        **kwargs,
+    ) -> asyncio.Future[Message]:
+        """
+        Queues a message. Texts are only merged with ``merge`` and without
+        further arguments like a ``reply_markup``.
+        """
+        self._ensure_worker()
+        future = self._loop.create_future()
+        future.add_done_callback(_retrieve_exception)
+        queue = self._queues.setdefault(chat_id, deque())
+        if any(item.action for item in queue):
+            # The message ends any chat action anyway
+            actions = sum(1 for item in queue if item.action)
+            metrics.OUTBOX_DROPPED_ACTIONS.inc(actions)
+            self._queues[chat_id] = queue = deque(
+                item for item in queue if not item.action
+            )
+        mergeable = merge and not kwargs
+        if (
+            mergeable
+            and queue
+            and queue[-1].mergeable
+            and queue[-1].bot is bot
+            and len(queue[-1].text) + len(text) + 2 <= MessageLimit.MAX_TEXT_LENGTH
+        ):
+            tail = queue[-1]
+            tail.text = f"{tail.text}\n\n{text}"
+            tail.priority = min(tail.priority, priority)
+            tail.futures.append(future)
+            metrics.OUTBOX_MERGED.inc()
+            return future
+        self._enqueue(
+            _Item(
+                bot,
+                chat_id,
+                priority,
+                next(self._seq),
+                text=text,
+                kwargs=kwargs,
+                mergeable=mergeable,
+                futures=[future],
+            )
+        )
+        return future
+
+    def edit_message_text(
+        self,
+        bot: Bot,
+        chat_id: int,
+        message_id: int,
+        text: str,
+        priority: Priority = Priority.DEFAULT,
+        **kwargs,
+    ) -> asyncio.Future[Message | bool]:
+        """
+        Queues an edit. An edit of the same message that is still waiting is
+        replaced, only the latest text is sent.
+        """
+        self._ensure_worker()
+        future = self._loop.create_future()
+        future.add_done_callback(_retrieve_exception)
+        queue = self._queues.setdefault(chat_id, deque())
+        for item in queue:
+            if item.message_id == message_id:
+                item.text = text
+                item.kwargs = kwargs
+                item.priority = min(item.priority, priority)
+                item.futures.append(future)
+                metrics.OUTBOX_MERGED.inc()
+                return future
+        self._enqueue(
+            _Item(
+                bot,
+                chat_id,
+                priority,
+                next(self._seq),
+                text=text,
+                message_id=message_id,
+                kwargs=kwargs,
+                futures=[future],
+            )
+        )
+        return future
+
+    def send_chat_action(
+        self,
+        bot: Bot,
+        chat_id: int,
+        action: str,
+        priority: Priority = Priority.DEFAULT,
+    ):
+        self._ensure_worker()
+        last_action, shown_since = self._last_action.get(chat_id, (None, 0))
+        if self._queues.get(chat_id) or (
+            last_action == action
+            and time.monotonic() - shown_since < CHAT_ACTION_DURATION
+        ):
+            metrics.OUTBOX_DROPPED_ACTIONS.inc()
+            return
+        self._queues.setdefault(chat_id, deque())
+        self._enqueue(_Item(bot, chat_id, priority, next(self._seq), action=action))
+
+    async def flush(self):
+        """
+        Waits until everything queued so far is sent.
+        """
+        if self._worker is not None and self._loop is asyncio.get_running_loop():
+            await self._idle.wait()
+
+    async def stop(self, timeout: float = 10):
+        if self._worker is None or self._loop is not asyncio.get_running_loop():
+            return
+        try:
+            await asyncio.wait_for(self.flush(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Outbox not empty on shutdown, messages are lost")
+        self._worker.cancel()
+        self._worker = None
+
+    def _enqueue(self, item: _Item):
+        self._queues[item.chat_id].append(item)
+        self._schedule(item.chat_id)
+        self._idle.clear()
+        self._wakeup.set()
+
+    def _schedule(self, chat_id: int, at: float | None = None):
+        if chat_id in self._sending or chat_id in self._scheduled:
+            return
+        head = self._queues[chat_id][0]
+        if at is None:
+            heapq.heappush(self._ready, (head.priority, head.seq, chat_id))
+        else:
+            heapq.heappush(self._paused, (at, head.priority, head.seq, chat_id))
+        self._scheduled.add(chat_id)
+
+    def _bucket(self, chat_id: int, now: float) -> TokenBucket:
+        if chat_id not in self._buckets:
+            if len(self._buckets) > 10000:
+                # Forget the chats that could send a burst again anyway
+                for other in list(self._buckets):
+                    if other not in self._queues and self._buckets[other].is_full(now):
+                        del self._buckets[other]
+                        self._last_action.pop(other, None)
+            self._buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return self._buckets[chat_id]
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            while self._paused and self._paused[0][0] <= now:
+                _, priority, seq, chat_id = heapq.heappop(self._paused)
+                heapq.heappush(self._ready, (priority, seq, chat_id))
+            if not self._ready:
+                timeout = self._paused[0][0] - now if self._paused else None
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            if delay := self._global.delay(now):
+                await asyncio.sleep(delay)
+                continue
+
+            _, seq, chat_id = heapq.heappop(self._ready)
+            self._scheduled.discard(chat_id)
+            queue = self._queues[chat_id]
+            if queue[0].seq != seq:
+                # The head was merged away or dropped since
+                self._schedule(chat_id)
+                continue
+            bucket = self._bucket(chat_id, now)
+            if delay := bucket.delay(now):
+                self._schedule(chat_id, now + delay)
+                continue
+            self._global.take()
+            bucket.take()
+            item = queue.popleft()
+            self._sending[chat_id] = asyncio.create_task(self._send(item))
+            metrics.OUTBOX_QUEUED.set(
+                sum(len(queue) for queue in self._queues.values())
+            )
+
+    async def _send(self, item: _Item):
+        chat_id = item.chat_id
+        try:
+            if item.action:
+                result = await item.bot.send_chat_action(
+                    chat_id=chat_id, action=item.action
+                )
+                self._last_action[chat_id] = (item.action, time.monotonic())
+            elif item.message_id:
+                result = await item.bot.edit_message_text(
+                    item.text,
+                    chat_id=chat_id,
+                    message_id=item.message_id,
+                    **item.kwargs,
+                )
+            else:
+                result = await item.bot.send_message(
+                    chat_id=chat_id, text=item.text, **item.kwargs
+                )
+                self._last_action.pop(chat_id, None)
+            for future in item.futures:
+                if not future.done():
+                    future.set_result(result)
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            if isinstance(retry_after, timedelta):
+                retry_after = retry_after.total_seconds()
+            logger.warning(f"Flood control in {chat_id}, retrying in {retry_after}s")
+            metrics.OUTBOX_RETRIES.inc()
+            self._queues[chat_id].appendleft(item)
+            del self._sending[chat_id]
+            self._schedule(chat_id, time.monotonic() + retry_after)
+            self._wakeup.set()
+            return
+        except Exception as e:
+            logger.warning(f"Could not send to {chat_id}: {e!r}")
+            metrics.OUTBOX_FAILED.inc()
+            for future in item.futures:
+                if not future.done():
+                    future.set_exception(e)
+        del self._sending[chat_id]
+        if self._queues[chat_id]:
+            self._schedule(chat_id)
+            self._wakeup.set()
+        else:
+            del self._queues[chat_id]
+            if not self._queues:
+                self._idle.set()
+
+
+outbox = Outbox()
@@ -0,0 +1,105 @@
+"""
+Per-group settings and day state. Everything lives in the ``group:{chat_id}:state``
+hash, so a single HGETALL is enough to handle a message. A bounded in-process
+LRU cache sits in front of it; every write through ``set_group_state``
+invalidates the cached copy.
+
+Fields: timezone, openai, debuglog, autochallenge, last_challenge, last_scored_day,
+settled_until
+
+``settled_until`` is the UTC timestamp until which no message of the group can
+change any score. It is mirrored in ``_settled_until``, so ordinary chatter
+is dismissed with a single integer comparison. Any other write clears it, and
+it is never set while a challenge is running.
+"""
+
+import os
+from collections import OrderedDict
+
+from db import redis
+
+CACHE_SIZE = int(os.environ.get("GROUP_STATE_CACHE_SIZE", 10000))
+
+_cache: OrderedDict[int, dict[str, str]] = OrderedDict()
+_settled_until: dict[int, int] = {}
+# KEYS: group state
+# ARGV: settled until
+# Returns 1 if the day was settled, 0 if a challenge is running
+SETTLE_SCRIPT = redis.register_script(
+    """
+if redis.call("HEXISTS", KEYS[1], "last_challenge") == 1 then
+    return 0
+end
+redis.call("HSET", KEYS[1], "settled_until", ARGV[1])
+return 1
+"""
+)
+
+# Bumped on every invalidation of a group, so a read that raced with a write
+# to the same group is not cached
+_generations: dict[int, int] = {}
+
+
+def group_state_key(chat_id: int) -> str:
+    return f"group:{chat_id}:state"
+
+
+async def get_group_state(chat_id: int) -> dict[str, str]:
+    if (state := _cache.get(chat_id)) is not None:
+        _cache.move_to_end(chat_id)
+        return state
+    generation = _generations.get(chat_id, 0)
+    state = await redis.hgetall(group_state_key(chat_id))
+    if generation == _generations.get(chat_id, 0):
+        _cache[chat_id] = state
+        _settled_until[chat_id] = int(state.get("settled_until", 0))
+        if len(_cache) > CACHE_SIZE:
+            evicted, _ = _cache.popitem(last=False)
+            _settled_until.pop(evicted, None)
+    return state
+
+
+def peek_group_state(chat_id: int) -> dict[str, str] | None:
+    """
+    Returns the cached state without querying redis, or None if it is not cached.
+    """
+    return _cache.get(chat_id)
+
+
+def get_settled_until(chat_id: int) -> int:
+    return _settled_until.get(chat_id, 0)
+
+
+async def settle_group_day(chat_id: int, until: int):
+    """
+    Sets ``settled_until``, unless a challenge was started since the state
+    was read.
+    """
+    settled = await SETTLE_SCRIPT(
+        keys=[group_state_key(chat_id)], args=[until], client=redis
+    )
+    if not settled:
+        invalidate_group_state(chat_id)
+    elif (state := _cache.get(chat_id)) is not None:
+        state["settled_until"] = str(until)
+        _settled_until[chat_id] = until
+
+
+async def set_group_state(chat_id: int, **fields: str | None):
+    """
+    Sets the given fields. A value of ``None`` removes the field.
+    """
+    fields.setdefault("settled_until", None)
+    pipe = redis.pipeline()
+    if values := {k: v for k, v in fields.items() if v is not None}:
+        pipe.hset(group_state_key(chat_id), mapping=values)
+    if removed := [k for k, v in fields.items() if v is None]:
+        pipe.hdel(group_state_key(chat_id), *removed)
+    await pipe.execute()
+    invalidate_group_state(chat_id)
+
+
+def invalidate_group_state(chat_id: int):
+    _generations[chat_id] = _generations.get(chat_id, 0) + 1
+    _cache.pop(chat_id, None)
+    _settled_until.pop(chat_id, None)
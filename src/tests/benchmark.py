@@ -0,0 +1,331 @@
+"""
+Replays the 13:37 burst against the real handlers, offline: a fake Bot API
+backend records every call and an in-memory redis stands in for the server.
+
+    python -m tests.benchmark --groups 200 --users 10 --output bench.json
+
+Every phase sends its updates for all groups at once and reports handler
+latency percentiles, redis round trips and Bot API calls per update, and
+throughput. Groups with AI replies get them from the local AI backend, with
+the latency given by ``--ai-latency``. The workload is deterministic, so
+results of two commits can be compared with ``--compare old.json``.
+"""
+
+import argparse
+import asyncio
+import json
+import subprocess
+import time
+from datetime import datetime
+
+import pytz
+from telegram import Chat, Message, MessageEntity, Update, User
+from telegram.ext import Application, CallbackContext, Job
+
+import ai
+import app
+import handlers
+from ai_backends import LocalBackend
+from challenges import question_pool_key
+from outbox import outbox
+from state import set_group_state
+from tests.fakes import (
+    REDIS_MODULES,
+    CountingConnection,
+    RecordingRequest,
+    make_fake_redis,
+    reset_caches,
+)
+
+TIMEZONE = pytz.timezone("Europe/Berlin")
+DAY = datetime(2024, 2, 2)
+
+
+class Benchmark:
+    def __init__(
+        self,
+        groups: int,
+        users: int,
+        openai_groups: int,
+        ai_latency: float = 0.0,
+        ai_chunk_delay: float = 0.0,
+        ai_error_rate: float = 0.0,
+    ):
+        self.groups = [-1000 - i for i in range(groups)]
+        self.users = [
+            User(id=1000 + i, first_name=f"User {i}", is_bot=False)
+            for i in range(users)
+        ]
+        self.openai_groups = set(self.groups[:openai_groups])
+        self.ai_backend = LocalBackend(
+            latency=ai_latency, chunk_delay=ai_chunk_delay, error_rate=ai_error_rate
+        )
+        self.request = RecordingRequest()
+        self.application: Application | None = None
+        self.update_id = 0
+        self.results = {}
+
+    async def setup(self):
+        redis = make_fake_redis()
+        for module in REDIS_MODULES:
+            module.redis = redis
+        reset_caches()
+        self.redis = redis
+        # The fake Bot API has no rate limits, don't wait for Telegram's
+        self.outbox_rates = outbox.rate, outbox.chat_rate
+        outbox.rate = outbox.chat_rate = 0
+        self.previous_ai_backend = ai.set_backend(self.ai_backend)
+        self.application = app.build_application(
+            Application.builder()
+            .token("123:abc")
+            .request(self.request)
+            .get_updates_request(RecordingRequest())
+        )
+        await self.application.initialize()
+        # Running, so the tasks handlers create are awaited on shutdown
+        await self.application.start()
+        for chat_id in self.groups:
+            await set_group_state(
+                chat_id,
+                timezone=TIMEZONE.zone,
+                last_scored_day="2024-02-01",
+                openai="1" if chat_id in self.openai_groups else None,
+            )
+        reset_caches()
+
+    async def teardown(self):
+        await outbox.stop()
+        outbox.rate, outbox.chat_rate = self.outbox_rates
+        ai.set_backend(self.previous_ai_backend)
+        await self.application.stop()
+        await self.application.shutdown()
+
+    def message(self, chat_id: int, user: User, at: datetime, text: str) -> Update:
+        self.update_id += 1
+        entities = []
+        if text.startswith("/"):
+            entities = [MessageEntity(MessageEntity.BOT_COMMAND, 0, len(text))]
+        message = Message(
+            message_id=self.update_id,
+            date=TIMEZONE.localize(at).astimezone(pytz.utc),
+            chat=Chat(id=chat_id, type=Chat.SUPERGROUP),
+            from_user=user,
+            text=text,
+            entities=entities,
+        )
+        message.set_bot(self.application.bot)
+        return Update(update_id=self.update_id, message=message)
+
+    async def phase(self, name: str, updates: list[Update]):
+        await self.run_phase(
+            name, [self.application.process_update(update) for update in updates]
+        )
+
+    async def run_phase(self, name: str, coroutines: list):
+        latencies = []
+
+        async def timed(coroutine):
+            start = time.perf_counter()
+            await coroutine
+            latencies.append(time.perf_counter() - start)
+
+        round_trips = CountingConnection.round_trips
+        api_calls = len(self.request.calls)
+        start = time.perf_counter()
+        await asyncio.gather(*[timed(coroutine) for coroutine in coroutines])
+        if handlers._answer_workers:
+            await asyncio.gather(*handlers._answer_workers.values())
+        if handlers._ai_replies:
+            await asyncio.gather(*handlers._ai_replies)
+        await outbox.flush()
+        duration = time.perf_counter() - start
+
+        latencies.sort()
+        n = len(latencies)
+        self.results[name] = {
+            "updates": n,
+            "p50_ms": round(latencies[n // 2] * 1000, 3),
+            "p99_ms": round(latencies[min(n - 1, int(n * 0.99))] * 1000, 3),
+            "max_ms": round(latencies[-1] * 1000, 3),
+            "redis_round_trips_per_update": round(
+                (CountingConnection.round_trips - round_trips) / n, 3
+            ),
+            "bot_api_calls_per_update": round(
+                (len(self.request.calls) - api_calls) / n, 3
+            ),
+            "updates_per_second": round(n / duration, 1),
+        }
+
+    async def run(self):
+        await self.setup()
+        try:
+            at = DAY.replace(hour=12)
+            await self.phase(
+                "chatter",
+                [
+                    self.message(chat_id, user, at, "Mahlzeit")
+                    for user in self.users
+                    for chat_id in self.groups
+                ],
+            )
+            at = DAY.replace(hour=13, minute=36, second=30)
+            await self.phase(
+                "too_early",
+                [
+                    self.message(chat_id, self.users[-1], at, "zu früh")
+                    for chat_id in self.groups
+                ],
+            )
+            at = DAY.replace(hour=13, minute=37, second=1)
+            await self.phase(
+                "1337",
+                [
+                    self.message(chat_id, user, at, "1337")
+                    for user in self.users
+                    for chat_id in self.groups
+                ],
+            )
+            await self.phase(
+                "score_command",
+                [
+                    self.message(chat_id, self.users[0], at, "/score")
+                    for chat_id in self.groups
+                ],
+            )
+            await self.challenges()
+        finally:
+            await self.teardown()
+        return self.results
+
+    async def challenges(self):
+        batch_window, handlers.ANSWER_BATCH_WINDOW = handlers.ANSWER_BATCH_WINDOW, 0
+        try:
+            await self.run_challenges()
+        finally:
+            handlers.ANSWER_BATCH_WINDOW = batch_window
+
+    async def run_challenges(self):
+        pipe = self.redis.pipeline()
+        for chat_id in self.groups:
+            pipe.rpush(
+                question_pool_key(datetime.now(pytz.utc).date()),
+                "Welcher Tag ist heute?",
+            )
+        await pipe.execute()
+        await self.run_phase(
+            "challenge_callback",
+            [
+                handlers.challenge_callback(
+                    CallbackContext.from_job(
+                        Job(handlers.challenge_callback, chat_id=chat_id),
+                        self.application,
+                    )
+                )
+                for chat_id in self.groups
+            ],
+        )
+        at = DAY.replace(hour=15)
+        await self.phase(
+            "challenge_answers",
+            [
+                self.message(chat_id, user, at, "Freitag")
+                for user in self.users
+                for chat_id in self.groups
+            ],
+        )
+
+
+COLUMNS = {
+    "updates": "updates",
+    "p50_ms": "p50 ms",
+    "p99_ms": "p99 ms",
+    "max_ms": "max ms",
+    "redis_round_trips_per_update": "redis/update",
+    "bot_api_calls_per_update": "api/update",
+    "updates_per_second": "updates/s",
+}
+
+
+def print_results(results: dict, baseline: dict | None = None):
+    width = 22 if baseline else 14
+    print(f"{'phase':<20}" + "".join(f"{title:>{width}}" for title in COLUMNS.values()))
+    for name, values in results.items():
+        cells = []
+        for column in COLUMNS:
+            cell = str(values[column])
+            if baseline and name in baseline and baseline[name].get(column):
+                change = values[column] / baseline[name][column] - 1
+                cell += f" ({change:+.0%})"
+            cells.append(f"{cell:>{width}}")
+        print(f"{name:<20}" + "".join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--groups", type=int, default=200)
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument(
+        "--openai-groups",
+        type=int,
+        default=0,
+        help="Number of groups with AI replies enabled",
+    )
+    parser.add_argument(
+        "--ai-latency",
+        type=float,
+        default=1.0,
+        help="Average seconds the local AI backend takes for a reply",
+    )
+    parser.add_argument(
+        "--ai-chunk-delay",
+        type=float,
+        default=0.05,
+        help="Seconds between the words of a streamed reply",
+    )
+    parser.add_argument(
+        "--ai-error-rate",
+        type=float,
+        default=0.0,
+        help="Share of AI queries that fail",
+    )
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results of a previous run")
+    args = parser.parse_args()
+
+    results = asyncio.run(
+        Benchmark(
+            args.groups,
+            args.users,
+            args.openai_groups,
+            ai_latency=args.ai_latency,
+            ai_chunk_delay=args.ai_chunk_delay,
+            ai_error_rate=args.ai_error_rate,
+        ).run()
+    )
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+    print_results(results, baseline)
+    if args.output:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True
+        ).stdout.strip()
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "commit": commit,
+                    "groups": args.groups,
+                    "users": args.users,
+                    "openai_groups": args.openai_groups,
+                    "ai_latency": args.ai_latency,
+                    "ai_error_rate": args.ai_error_rate,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
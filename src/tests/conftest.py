@@ -0,0 +1,19 @@
+import pytest
+
+from outbox import outbox
+from tests.fakes import REDIS_MODULES, make_fake_redis, reset_caches
+
+
+@pytest.fixture
+def redis(monkeypatch):
+    fake = make_fake_redis()
+    for module in REDIS_MODULES:
+        monkeypatch.setattr(module, "redis", fake)
+    reset_caches()
+    return fake
+
+
+@pytest.fixture(autouse=True)
+async def stop_outbox():
+    yield
+    await outbox.stop()
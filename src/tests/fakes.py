@@ -0,0 +1,102 @@
+import json
+import time
+
+from fakeredis import FakeAsyncRedis, FakeAsyncRedisConnection
+from telegram.request import BaseRequest, RequestData
+
+import challenges
+import cleanup
+import migrations
+import names
+import state
+import utils
+
+# Modules that import the shared redis client
+REDIS_MODULES = (utils, migrations, state, challenges, cleanup, names)
+
+BOT_USER = {
+    "id": 42,
+    "is_bot": True,
+    "first_name": "l33t score bot",
+    "username": "leet_score_bot",
+}
+
+
+class RecordingRequest(BaseRequest):
+    """
+    Answers Bot API calls locally instead of sending them to Telegram and
+    records them, so the handlers can run without a network.
+    """
+
+    def __init__(self):
+        self.calls: list[tuple[str, dict]] = []
+        self._message_id = 0
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def calls_to(self, endpoint: str) -> list[dict]:
+        return [params for name, params in self.calls if name == endpoint]
+
+    async def do_request(
+        self,
+        url: str,
+        method: str,
+        request_data: RequestData | None = None,
+        read_timeout=None,
+        write_timeout=None,
+        connect_timeout=None,
+        pool_timeout=None,
+    ) -> tuple[int, bytes]:
+        endpoint = url.rpartition("/")[2]
+        params = request_data.parameters if request_data else {}
+        self.calls.append((endpoint, params))
+        body = {"ok": True, "result": self._result(endpoint, params)}
+        return 200, json.dumps(body).encode()
+
+    def _result(self, endpoint: str, params: dict):
+        if endpoint == "getMe":
+            return BOT_USER
+        if endpoint in ("sendMessage", "editMessageText"):
+            self._message_id += 1
+            return {
+                "message_id": params.get("message_id", self._message_id),
+                "date": int(time.time()),
+                "chat": {"id": params.get("chat_id", 0), "type": "group"},
+                "from": BOT_USER,
+                "text": params.get("text", ""),
+            }
+        if endpoint == "getUpdates":
+            return []
+        return True
+
+
+class CountingConnection(FakeAsyncRedisConnection):
+    """
+    Counts round trips: a single command or a whole pipeline.
+    """
+
+    round_trips = 0
+
+    async def send_packed_command(self, command, check_health=True):
+        CountingConnection.round_trips += 1
+        await super().send_packed_command(command, check_health)
+
+
+def make_fake_redis() -> FakeAsyncRedis:
+    return FakeAsyncRedis(decode_responses=True, connection_class=CountingConnection)
+
+
+def reset_caches():
+    state._cache.clear()
+    state._settled_until.clear()
+    state._generations.clear()
+    utils._rankings.clear()
+    names._cache.clear()
@@ -0,0 +1,37 @@
+from ai import build_prompt, compact_scoreboard, estimate_tokens
+
+RANKING = [(i, f"User {i}", 100 - i) for i in range(1, 41)] + [(42, "Bot", 0)]
+
+
+def test_compact_scoreboard_shows_top_and_focus():
+    scoreboard = compact_scoreboard(RANKING, focus=[20, 42], top=3)
+    assert scoreboard.split("\n") == [
+        "1. User 1: 99",
+        "2. User 2: 98",
+        "3. User 3: 97",
+        "…",
+        "19. User 19: 81",
+        "20. User 20: 80",
+        "21. User 21: 79",
+        "…",
+        "40. User 40: 60",
+        "41. Bot: 0",
+        "(33 weitere mit 61 bis 96 Punkten)",
+    ]
+
+
+def test_compact_scoreboard_ties_share_a_rank():
+    ranking = [(1, "Alice", 3), (2, "Bob", 3), (3, "Carol", 1)]
+    assert compact_scoreboard(ranking) == "1. Alice: 3\n1. Bob: 3\n3. Carol: 1"
+
+
+def test_build_prompt_fits_scoreboard_into_budget():
+    full = build_prompt("Aufgabe", ["Fakt"], RANKING, focus=[42], budget=10000)
+    assert "5. User 5: 95" in full
+
+    prompt = build_prompt("Aufgabe", ["Fakt"], RANKING, focus=[42], budget=50)
+    assert estimate_tokens(prompt) <= 50
+    assert prompt.startswith("Aufgabe\n- Fakt\n")
+    assert "41. Bot: 0" in prompt
+    assert "3. User 3: 97" in prompt
+    assert "4. User 4: 96" not in prompt
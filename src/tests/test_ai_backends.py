@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+
+import ai
+from ai_backends import Backend, BackendError, LocalBackend
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    backend = LocalBackend(
+        latency=0.01,
+        script={"judge": ["1. Falsch\n2. Richtig", "Richtig"]},
+    )
+    monkeypatch.setattr(ai, "_backend", backend)
+    return backend
+
+
+async def test_local_backend_answers_from_script(backend):
+    assert await ai.judge_answers("Frage?", ["a", "b"]) == [False, True]
+    # The last scripted answer is repeated
+    assert await ai.judge_answers("Frage?", ["c"]) == [True]
+    assert await ai.judge_answers("Frage?", ["d"]) == [True]
+
+
+async def test_answers_without_verdict_are_judged_again(backend):
+    backend.script["judge"] = ["1. Richtig\n2. Vielleicht", "Falsch", "Keine Ahnung"]
+    # The second answer is judged again on its own
+    assert await ai.judge_answers("Frage?", ["a", "b"]) == [True, False]
+    assert await ai.judge_answers("Frage?", ["c"]) == [None]
+
+
+async def test_local_backend_streams_templates(backend):
+    chunks = [
+        chunk
+        async for chunk in ai.stream_query("Anweisung", prompt_type="challenge_lost")
+    ]
+    assert len(chunks) > 1
+    assert "".join(chunks) == "Leider falsch, der Punkt gehört mir, Antwort 1."
+
+
+async def test_local_backend_injects_errors_and_latency():
+    backend = LocalBackend(latency=0.05, error_rate=0.5, seed=1)
+    messages = [{"role": "system", "content": "Anweisung"}]
+    outcomes = []
+    start = asyncio.get_running_loop().time()
+    for _ in range(10):
+        try:
+            await backend.complete(messages, "success")
+            outcomes.append("ok")
+        except BackendError:
+            outcomes.append("error")
+    assert asyncio.get_running_loop().time() - start >= 10 * 0.05 * 0.5
+    assert "ok" in outcomes and "error" in outcomes
+
+    # The same seed fails the same queries
+    again = LocalBackend(latency=0, error_rate=0.5, seed=1)
+    for outcome in outcomes:
+        try:
+            await again.complete(messages, "success")
+            assert outcome == "ok"
+        except BackendError:
+            assert outcome == "error"
+
+
+def test_incomplete_backend_cannot_be_created():
+    class CompleteOnly(Backend):
+        async def complete(self, messages, prompt_type):
+            pass
+
+    with pytest.raises(TypeError):
+        CompleteOnly()
@@ -1,2 +1,72 @@
+import asyncio
+import socket
+
+import httpx
+from telegram.ext import Application
+
+import app
+from tests.fakes import RecordingRequest
+
+START_UPDATE = {
+    "update_id": 1,
+    "message": {
+        "message_id": 1,
+        "date": 1707482220,
+        "chat": {"id": 19426036, "type": "private", "first_name": "Alice"},
+        "from": {"id": 19426036, "is_bot": False, "first_name": "Alice"},
+        "text": "/start",
+        "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+    },
+}
+
+
 def test_placeholder():
     assert True
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def test_webhook_accepts_recorded_updates(redis):
+    request = RecordingRequest()
+    application = app.build_application(
+        Application.builder()
+        .token("123:abc")
+        .request(request)
+        .get_updates_request(RecordingRequest())
+    )
+    port = free_port()
+    await application.initialize()
+    await application.updater.start_webhook(
+        listen="127.0.0.1",
+        port=port,
+        url_path="telegram",
+        webhook_url="https://example.com/telegram",
+        secret_token="s3cret",
+    )
+    await application.start()
+    try:
+        async with httpx.AsyncClient() as client:
+            url = f"http://127.0.0.1:{port}/telegram"
+            denied = await client.post(url, json=START_UPDATE)
+            accepted = await client.post(
+                url,
+                json=START_UPDATE,
+                headers={"X-Telegram-Bot-Api-Secret-Token": "s3cret"},
+            )
+        for _ in range(100):
+            if request.calls_to("sendMessage"):
+                break
+            await asyncio.sleep(0.01)
+    finally:
+        await application.updater.stop()
+        await application.stop()
+        await application.shutdown()
+
+    assert denied.status_code == 403
+    assert accepted.status_code == 200
+    assert request.calls_to("setWebhook")[0]["secret_token"] == "s3cret"
+    assert request.calls_to("sendMessage")[0]["text"].startswith("Hi there!")
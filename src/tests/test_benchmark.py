@@ -0,0 +1,15 @@
+from tests.benchmark import Benchmark
+
+
+async def test_benchmark_runs_every_phase():
+    results = await Benchmark(groups=3, users=2, openai_groups=1).run()
+    assert list(results) == [
+        "chatter",
+        "too_early",
+        "1337",
+        "score_command",
+        "challenge_callback",
+        "challenge_answers",
+    ]
+    assert results["1337"]["updates"] == 6
+    assert results["score_command"]["bot_api_calls_per_update"] == 1
@@ -0,0 +1,76 @@
+from datetime import datetime, timedelta
+from unittest.mock import AsyncMock, MagicMock
+
+import pytz
+
+import challenges
+import handlers
+from challenges import add_pending_challenge, get_pending_challenges
+from state import get_group_state
+
+
+async def test_restore_challenges(redis):
+    now = datetime.now(pytz.utc)
+    await add_pending_challenge(-100, (now + timedelta(hours=1)).timestamp())
+    await add_pending_challenge(-200, (now - timedelta(hours=1)).timestamp())
+    job_queue = MagicMock()
+    job_queue.get_jobs_by_name.return_value = []
+
+    await handlers.restore_challenges(job_queue)
+
+    when = {
+        call.kwargs["chat_id"]: call.args[1]
+        for call in job_queue.run_once.call_args_list
+    }
+    assert when[-100] - now > timedelta(minutes=59)
+    assert when[-200] - now < timedelta(seconds=1)
+    for call in job_queue.run_once.call_args_list:
+        assert call.kwargs["job_kwargs"] == {"misfire_grace_time": None}
+    assert [chat_id for chat_id, _ in await get_pending_challenges()] == [-200, -100]
+
+
+async def test_failed_challenge_stays_pending(redis, monkeypatch):
+    questions = [RuntimeError("OpenAI is down"), "Frage?"]
+
+    async def get_challenge_message(logger_extra=None):
+        question = questions.pop(0)
+        if isinstance(question, Exception):
+            raise question
+        return question
+
+    monkeypatch.setattr(handlers.ai, "get_challenge_message", get_challenge_message)
+    due = datetime.now(pytz.utc)
+    await add_pending_challenge(-100, due.timestamp())
+    context = MagicMock()
+    context.bot = AsyncMock(id=42)
+    context.job.chat_id = -100
+    context.job.data = {"due": due.timestamp()}
+    context.job_queue.get_jobs_by_name.return_value = []
+
+    await handlers.challenge_callback(context)
+    assert await get_pending_challenges() == [(-100, due.timestamp())]
+    retry = context.job_queue.run_once.call_args
+    assert retry.kwargs["chat_id"] == -100
+    assert retry.args[1] - due >= handlers.CHALLENGE_RETRY_DELAY
+
+    await handlers.challenge_callback(context)
+    assert await get_pending_challenges() == []
+    assert (await get_group_state(-100))["last_challenge"] == "Frage?"
+
+
+async def test_question_pool(redis, monkeypatch):
+    async def get_challenge_message(day):
+        return f"Frage zum {day:%d.%m}"
+
+    monkeypatch.setattr(challenges.ai, "get_backend", lambda: object())
+    monkeypatch.setattr(challenges.ai, "get_challenge_message", get_challenge_message)
+    due = datetime.now(pytz.utc) + timedelta(hours=2)
+    await add_pending_challenge(-100, due.timestamp())
+    await add_pending_challenge(-200, due.timestamp())
+
+    await challenges.fill_question_pools()
+    await challenges.fill_question_pools()
+
+    assert await redis.llen(challenges.question_pool_key(due.date())) == 2
+    question = await challenges.pop_pooled_question(due.date())
+    assert question == f"Frage zum {due:%d.%m}"
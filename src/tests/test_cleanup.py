@@ -0,0 +1,64 @@
+from telegram import User
+
+import cleanup
+import migrations
+from cleanup import (
+    PROGRESS_KEY,
+    REMOVED_GROUPS_KEY,
+    RUNNING_GROUPS_KEY,
+    cancel_group_cleanup,
+    cleanup_removed_groups,
+    drop_group,
+)
+from utils import LEADERBOARD_USERS_KEY, award
+
+
+async def test_drop_group_and_cleanup_leftovers(redis, monkeypatch):
+    monkeypatch.setattr(cleanup, "SCAN_COUNT", 2)
+    for chat_id in (-100, -200):
+        await redis.zadd(f"group:{chat_id}:scores", {"1": 3})
+        await redis.hset(f"group:{chat_id}:state", "timezone", "UTC")
+        for i in range(5):
+            await redis.set(f"group:{chat_id}:legacy:{i}", 1)
+
+    await drop_group(-100, 42)
+
+    assert not await redis.exists("group:-100:scores", "group:-100:state")
+    assert await redis.smembers(REMOVED_GROUPS_KEY) == {"-100"}
+    assert await cleanup_removed_groups() == 5
+    assert await redis.keys("group:-100:*") == []
+    assert len(await redis.keys("group:-200:*")) == 7
+    assert not await redis.exists(REMOVED_GROUPS_KEY, RUNNING_GROUPS_KEY, PROGRESS_KEY)
+
+
+async def test_drop_group_matches_a_rebuilt_leaderboard(redis):
+    alice = User(id=1, first_name="Alice", is_bot=False)
+    bob = User(id=2, first_name="Bob", is_bot=False)
+    bot = User(id=42, first_name="Bot", is_bot=True)
+    await award(-100, [(alice, 3), (bob, 1), (bot, 2)])
+    await award(-200, [(alice, 1), (bot, 5)])
+
+    await drop_group(-100, 42)
+    leaderboard = await redis.zrange(LEADERBOARD_USERS_KEY, 0, -1, withscores=True)
+
+    await migrations.rebuild_leaderboards(42, force=True)
+    assert leaderboard == [("1", 1)]
+    assert (
+        await redis.zrange(LEADERBOARD_USERS_KEY, 0, -1, withscores=True) == leaderboard
+    )
+
+
+async def test_cleanup_resumes_and_spares_readded_groups(redis):
+    for chat_id in (-100, -200):
+        await redis.set(f"group:{chat_id}:legacy", 1)
+        await drop_group(chat_id, 42)
+    # A pass that was interrupted after its first batch
+    await redis.rename(REMOVED_GROUPS_KEY, RUNNING_GROUPS_KEY)
+    cursor, _ = await redis.scan(0, match="group:*", count=1)
+    await redis.hset(PROGRESS_KEY, "cursor", cursor or 1)
+    await cancel_group_cleanup(-200)
+
+    await cleanup_removed_groups()
+
+    assert await redis.exists("group:-200:legacy")
+    assert not await redis.exists(RUNNING_GROUPS_KEY, PROGRESS_KEY)
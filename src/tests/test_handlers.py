@@ -0,0 +1,248 @@
+import asyncio
+from datetime import datetime
+from unittest.mock import AsyncMock, MagicMock
+
+import pytz
+from telegram import Chat, Message, Update, User
+
+import handlers
+from outbox import outbox
+from state import get_settled_until, set_group_state
+
+BERLIN = pytz.timezone("Europe/Berlin")
+ALICE = User(id=1, first_name="Alice", is_bot=False)
+
+
+def make_update(
+    hour: int, minute: int, day: int = 2, user: User = ALICE, text: str = "hi"
+) -> Update:
+    date = BERLIN.localize(datetime(2024, 2, day, hour, minute, 5))
+    message = Message(
+        message_id=1,
+        date=date.astimezone(pytz.utc),
+        chat=Chat(id=-100, type=Chat.GROUP),
+        from_user=user,
+        text=text,
+    )
+    return Update(update_id=1, message=message)
+
+
+def make_context() -> MagicMock:
+    context = MagicMock()
+    context.bot = AsyncMock(id=42, first_name="Bot")
+    context.application.create_task = lambda coroutine, update: asyncio.create_task(
+        coroutine
+    )
+    return context
+
+
+async def test_settled_day_skips_ordinary_chatter(redis):
+    await set_group_state(-100, timezone="Europe/Berlin", last_scored_day="2024-02-02")
+    context = make_context()
+
+    await handlers.group_chat_message(make_update(15, 0), context)
+    settled_until = BERLIN.localize(datetime(2024, 2, 3, 13, 36))
+    assert get_settled_until(-100) == settled_until.timestamp()
+
+    await redis.delete("group:-100:state")
+    await handlers.group_chat_message(make_update(9, 0, day=3), context)
+    await outbox.flush()
+    context.bot.send_message.assert_not_called()
+
+
+async def test_settled_day_ends_at_1336(redis):
+    await set_group_state(-100, timezone="Europe/Berlin", last_scored_day="2024-02-01")
+    context = make_context()
+
+    await handlers.group_chat_message(make_update(9, 0), context)
+    await handlers.group_chat_message(make_update(13, 37), context)
+    assert await redis.zscore("group:-100:scores", ALICE.id) == 1
+    assert (await redis.hgetall("group:-100:state"))["last_scored_day"] == "2024-02-02"
+
+
+async def test_started_challenge_keeps_the_day_unsettled(redis, monkeypatch):
+    settle_group_day = handlers.settle_group_day
+
+    async def settle_after_challenge_started(chat_id, until):
+        # The challenge job runs between the read of the state and the write
+        await set_group_state(chat_id, last_challenge="Frage?")
+        await settle_group_day(chat_id, until)
+
+    monkeypatch.setattr(handlers, "settle_group_day", settle_after_challenge_started)
+    await set_group_state(-100, timezone="Europe/Berlin", last_scored_day="2024-02-02")
+    await handlers.group_chat_message(make_update(15, 0), make_context())
+    assert get_settled_until(-100) == 0
+    assert "settled_until" not in await redis.hgetall("group:-100:state")
+
+
+async def test_challenge_answers_are_judged_in_one_batch(redis, monkeypatch):
+    judged = []
+
+    async def judge_answers(question, answers, logger_extra=None):
+        judged.append(answers)
+        return ["richtig" in answer for answer in answers]
+
+    async def stream_message(**kwargs):
+        yield kwargs["username"]
+
+    monkeypatch.setattr(handlers, "ANSWER_BATCH_WINDOW", 0.01)
+    monkeypatch.setattr(handlers.ai, "judge_answers", judge_answers)
+    monkeypatch.setattr(handlers.ai, "stream_challenge_won_message", stream_message)
+    monkeypatch.setattr(handlers.ai, "stream_challenge_lost_message", stream_message)
+    await set_group_state(-100, timezone="Europe/Berlin", last_challenge="Frage?")
+    context = make_context()
+
+    users = [User(id=i, first_name=f"User {i}", is_bot=False) for i in range(1, 4)]
+    for user, text in zip(users, ["falsch", "richtig", "auch richtig"]):
+        await handlers.group_chat_message(
+            make_update(15, 0, user=user, text=text), context
+        )
+    await handlers._answer_workers[-100]
+    await asyncio.gather(*handlers._ai_replies)
+    await outbox.flush()
+
+    assert judged == [["falsch", "richtig", "auch richtig"]]
+    sent = [call.kwargs["text"] for call in context.bot.send_message.call_args_list]
+    assert sorted(sent) == ["User 1", "User 2"]
+    assert await redis.zscore("group:-100:scores", 2) == 1
+    assert await redis.zscore("group:-100:scores", 3) is None
+    assert "last_challenge" not in await redis.hgetall("group:-100:state")
+
+
+async def test_challenge_is_scored_before_the_replies_are_generated(redis, monkeypatch):
+    async def judge_answers(question, answers, logger_extra=None):
+        return ["richtig" in answer for answer in answers]
+
+    async def stream_message(**kwargs):
+        await asyncio.Event().wait()
+        yield kwargs["username"]
+
+    monkeypatch.setattr(handlers, "ANSWER_BATCH_WINDOW", 0.01)
+    monkeypatch.setattr(handlers.ai, "judge_answers", judge_answers)
+    monkeypatch.setattr(handlers.ai, "stream_challenge_won_message", stream_message)
+    monkeypatch.setattr(handlers.ai, "stream_challenge_lost_message", stream_message)
+    await set_group_state(-100, timezone="Europe/Berlin", last_challenge="Frage?")
+    context = make_context()
+
+    users = [User(id=i, first_name=f"User {i}", is_bot=False) for i in range(1, 4)]
+    for user, text in zip(users, ["falsch", "auch falsch", "richtig"]):
+        await handlers.group_chat_message(
+            make_update(15, 0, user=user, text=text), context
+        )
+    await handlers._answer_workers[-100]
+
+    scores = await redis.zrange("group:-100:scores", 0, -1, withscores=True)
+    assert dict(scores) == {"1": -1, "2": -1, "3": 1, "42": 2}
+    assert len(handlers._ai_replies) == 3
+    for reply in handlers._ai_replies:
+        reply.cancel()
+    await asyncio.gather(*handlers._ai_replies, return_exceptions=True)
+
+
+async def test_late_answers_are_not_judged_against_the_next_challenge(
+    redis, monkeypatch
+):
+    judged = []
+
+    async def judge_answers(question, answers, logger_extra=None):
+        judged.append((question, answers))
+        return ["richtig" in answer for answer in answers]
+
+    async def challenge_won(challenge, update, context):
+        # The next challenge is posted while an answer to this one arrives
+        await set_group_state(-100, last_challenge="Q2")
+        for asked, text in [("Q1", "late"), ("Q2", "x")]:
+            await handlers.group_chat_message_with_challenges(
+                asked, make_update(15, 1, text=text), context
+            )
+
+    async def challenge_lost(challenge, update, context):
+        pass
+
+    monkeypatch.setattr(handlers, "ANSWER_BATCH_WINDOW", 0.01)
+    monkeypatch.setattr(handlers.ai, "judge_answers", judge_answers)
+    monkeypatch.setattr(handlers, "_challenge_won", challenge_won)
+    monkeypatch.setattr(handlers, "_challenge_lost", challenge_lost)
+    await set_group_state(-100, timezone="Europe/Berlin", last_challenge="Q1")
+    context = make_context()
+
+    await handlers.group_chat_message(make_update(15, 0, text="richtig"), context)
+    await handlers._answer_workers[-100]
+
+    assert judged == [("Q1", ["richtig"]), ("Q2", ["x"])]
+    assert -100 not in handlers._pending_answers
+
+
+async def test_ai_reply_replaces_fallback_within_budget(redis, monkeypatch):
+    async def get_success_message(*args, **kwargs):
+        await asyncio.sleep(delay)
+        return "Generated"
+
+    monkeypatch.setattr(handlers, "AI_REPLY_BUDGET", 0.05)
+    monkeypatch.setattr(handlers.ai, "get_backend", lambda: object())
+    monkeypatch.setattr(handlers.ai, "get_success_message", get_success_message)
+    context = make_context()
+    context.bot.send_message.return_value = MagicMock(message_id=7)
+
+    for day, delay in [(2, 0), (3, 1)]:
+        await set_group_state(-100, timezone="Europe/Berlin", openai="1")
+        await handlers.group_chat_message(make_update(13, 37, day=day), context)
+        await asyncio.gather(*handlers._ai_replies)
+        await outbox.flush()
+
+    sent = [call.kwargs["text"] for call in context.bot.send_message.call_args_list]
+    assert sent == [
+        "Congratz, Alice! Scores:\n\n- Alice: 1",
+        "Congratz, Alice! Scores:\n\n- Alice: 2",
+    ]
+    # Only the first reply arrived in time
+    context.bot.edit_message_text.assert_called_once_with(
+        "Generated", chat_id=-100, message_id=7
+    )
+
+
+async def test_streamed_reply_is_shown_by_throttled_edits(monkeypatch):
+    async def chunks():
+        for chunk in ["Richtig", ", Alice", "!", " Fun", " Fact"]:
+            yield chunk
+            await asyncio.sleep(0.02)
+
+    monkeypatch.setattr(handlers, "AI_STREAM_EDIT_INTERVAL", 0.05)
+    context = make_context()
+    context.bot.send_message.return_value = MagicMock(message_id=7)
+
+    await handlers._send_streamed(context, -100, "challenge_won", chunks(), "Fallback")
+    await outbox.flush()
+
+    context.bot.send_message.assert_called_once_with(chat_id=-100, text="Richtig")
+    edits = [call.args[0] for call in context.bot.edit_message_text.call_args_list]
+    # Not every chunk leads to an edit, but the last one shows the whole text
+    assert 1 <= len(edits) < 4
+    assert edits[-1] == "Richtig, Alice! Fun Fact"
+
+
+async def test_failed_stream_falls_back_and_keeps_autochallenge(redis, monkeypatch):
+    async def stream_message(**kwargs):
+        raise RuntimeError("stream failed")
+        yield
+
+    challenges = []
+
+    async def challenge_command(update, context):
+        challenges.append(update.message.chat_id)
+
+    monkeypatch.setattr(handlers.ai, "stream_challenge_won_message", stream_message)
+    monkeypatch.setattr(handlers, "challenge_command", challenge_command)
+    await set_group_state(
+        -100, timezone="Europe/Berlin", last_challenge="Frage?", autochallenge="1"
+    )
+    context = make_context()
+
+    await handlers._challenge_won("Frage?", make_update(15, 0), context)
+    await asyncio.gather(*handlers._ai_replies)
+    await outbox.flush()
+
+    context.bot.send_message.assert_called_once_with(
+        chat_id=-100, text="Correct, Alice! That's a point for you."
+    )
+    assert challenges == [-100]
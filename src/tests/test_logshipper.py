@@ -0,0 +1,41 @@
+import asyncio
+import logging
+from unittest.mock import AsyncMock
+
+import logshipper
+from state import set_group_state
+
+
+def test_split_message():
+    text = "\n".join(["x" * 30] * 10)
+    parts = logshipper.split_message(text, limit=100)
+    assert all(len(part) <= 100 for part in parts)
+    assert "\n".join(parts) == text
+    assert logshipper.split_message("y" * 250, limit=100) == ["y" * 100] * 2 + [
+        "y" * 50
+    ]
+
+
+async def test_records_are_coalesced_per_chat(redis, monkeypatch):
+    monkeypatch.setattr(logshipper, "FLUSH_INTERVAL", 0.05)
+    await set_group_state(-100, debuglog="1")
+    await set_group_state(-200, timezone="UTC")
+    bot = AsyncMock()
+    handler = logshipper.TelegramMessageLogHandler()
+    test_logger = logging.getLogger("test_logshipper")
+    test_logger.addHandler(handler)
+    handler.start(bot)
+    try:
+        for i in range(3):
+            test_logger.warning(f"<b>{i}</b>", extra={"chat_id": -100})
+            test_logger.warning(f"<b>{i}</b>", extra={"chat_id": -200})
+        test_logger.warning("<pre>" + "z" * 5000 + "</pre>", extra={"chat_id": -100})
+        await asyncio.sleep(0.2)
+    finally:
+        await handler.stop()
+        test_logger.removeHandler(handler)
+    texts = [call.kwargs["text"] for call in bot.send_message.call_args_list]
+    chats = {call.kwargs["chat_id"] for call in bot.send_message.call_args_list}
+    assert chats == {-100}
+    assert texts[0] == "<b>0</b>\n\n<b>1</b>\n\n<b>2</b>"
+    assert "".join(texts[1:]) == "z" * 5000
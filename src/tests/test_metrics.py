@@ -0,0 +1,44 @@
+from fakeredis import FakeServer
+from fakeredis.aioredis import FakeAsyncRedisConnection
+from prometheus_client import REGISTRY
+from redis.asyncio import ConnectionPool
+
+import metrics
+from db import InstrumentedRedis
+
+
+def sample(name: str, labels: dict) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+async def test_redis_commands_and_pipelines_are_observed():
+    redis = InstrumentedRedis(
+        connection_pool=ConnectionPool(
+            connection_class=FakeAsyncRedisConnection,
+            server=FakeServer(),
+            decode_responses=True,
+        )
+    )
+    sets = sample("redis_command_latency_seconds_count", {"command": "SET"})
+    pipelines = sample("redis_command_latency_seconds_count", {"command": "PIPELINE"})
+
+    await redis.set("a", 1)
+    async with redis.pipeline() as pipe:
+        await pipe.get("a").get("b").execute()
+
+    assert sample("redis_command_latency_seconds_count", {"command": "SET"}) == sets + 1
+    assert (
+        sample("redis_command_latency_seconds_count", {"command": "PIPELINE"})
+        == pipelines + 1
+    )
+
+
+async def test_timed_handler():
+    async def some_handler(update, context):
+        return "done"
+
+    handler = metrics.timed_handler(some_handler)
+
+    assert await handler(None, None) == "done"
+    assert handler.__name__ == "some_handler"
+    assert sample("handler_latency_seconds_count", {"handler": "some_handler"}) == 1
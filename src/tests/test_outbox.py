@@ -0,0 +1,48 @@
+from unittest.mock import AsyncMock
+
+from telegram.constants import ChatAction
+from telegram.error import RetryAfter
+
+from outbox import Outbox, Priority
+
+
+async def test_texts_are_merged_and_actions_dropped():
+    outbox = Outbox()
+    bot = AsyncMock()
+    outbox.send_chat_action(bot, -100, ChatAction.TYPING)
+    first = outbox.send_message(bot, -100, "Congratz, Alice! Scores:")
+    second = outbox.send_message(bot, -100, "- Alice: 1")
+    outbox.send_chat_action(bot, -100, ChatAction.TYPING)
+    outbox.send_message(bot, -100, "Pick one", reply_markup="markup")
+    await outbox.stop()
+
+    bot.send_chat_action.assert_not_called()
+    assert [call.kwargs for call in bot.send_message.call_args_list] == [
+        {"chat_id": -100, "text": "Congratz, Alice! Scores:\n\n- Alice: 1"},
+        {"chat_id": -100, "text": "Pick one", "reply_markup": "markup"},
+    ]
+    assert await first is await second
+
+
+async def test_priorities_and_chat_budget():
+    outbox = Outbox(rate=0, chat_rate=10, chat_burst=1)
+    bot = AsyncMock()
+    outbox.send_message(bot, -1, "log", priority=Priority.DEBUG)
+    outbox.send_message(bot, -2, "command")
+    outbox.send_message(bot, -3, "1337", priority=Priority.GAME)
+    outbox.send_message(bot, -3, "again", priority=Priority.GAME, merge=False)
+    await outbox.stop()
+
+    sent = [call.kwargs["text"] for call in bot.send_message.call_args_list]
+    # The second message of -3 has to wait for its chat's budget
+    assert sent == ["1337", "command", "log", "again"]
+
+
+async def test_flood_control_is_retried():
+    outbox = Outbox()
+    bot = AsyncMock()
+    bot.send_message.side_effect = [RetryAfter(0.01), "message"]
+
+    assert await outbox.send_message(bot, -100, "1337") == "message"
+    assert bot.send_message.call_count == 2
+    await outbox.stop()
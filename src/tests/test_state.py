@@ -0,0 +1,62 @@
+import migrations
+from state import get_group_state, invalidate_group_state, set_group_state
+
+
+async def test_group_state_is_cached(redis):
+    await set_group_state(-100, timezone="Europe/Berlin", openai="1")
+    assert await get_group_state(-100) == {"timezone": "Europe/Berlin", "openai": "1"}
+    await redis.hset("group:-100:state", "debuglog", "1")
+    assert "debuglog" not in await get_group_state(-100)
+
+
+async def test_set_group_state_invalidates(redis):
+    await set_group_state(-100, timezone="Europe/Berlin", autochallenge="1")
+    await get_group_state(-100)
+    await set_group_state(-100, timezone="UTC", autochallenge=None)
+    assert await get_group_state(-100) == {"timezone": "UTC"}
+
+
+async def test_racing_writes_only_skip_caching_the_same_group(redis, monkeypatch):
+    await redis.hset("group:-100:state", "timezone", "Europe/Berlin")
+    await redis.hset("group:-200:state", "timezone", "UTC")
+    hgetall = redis.hgetall
+
+    async def hgetall_during_writes(key):
+        state = await hgetall(key)
+        invalidate_group_state(-300)
+        if key == "group:-200:state":
+            invalidate_group_state(-200)
+        return state
+
+    monkeypatch.setattr(redis, "hgetall", hgetall_during_writes)
+    await get_group_state(-100)
+    await get_group_state(-200)
+    await redis.hset("group:-100:state", "debuglog", "1")
+    await redis.hset("group:-200:state", "debuglog", "1")
+    assert "debuglog" not in await get_group_state(-100)
+    assert "debuglog" in await get_group_state(-200)
+
+
+async def test_migrate_group_state_keys(redis):
+    await redis.set("group:-100:settings:timezone", "Europe/Berlin")
+    await redis.set("group:-100:settings:openai:debuglog", "1")
+    await redis.set("group:-100:last_scored_day", "2024-02-01")
+    await redis.zadd("group:-100:scores", {"1": 3})
+    assert await migrations.migrate_group_state_keys() == 3
+    assert await get_group_state(-100) == {
+        "timezone": "Europe/Berlin",
+        "debuglog": "1",
+        "last_scored_day": "2024-02-01",
+    }
+    assert await redis.exists("group:-100:settings:timezone") == 0
+
+
+async def test_group_state_migration_runs_once(redis):
+    await migrations.run()
+    assert await redis.smembers(migrations.DONE_KEY) == {
+        "score_keys",
+        "group_state_keys",
+    }
+    await redis.set("group:-100:settings:timezone", "Europe/Berlin")
+    await migrations.run()
+    assert await redis.exists("group:-100:settings:timezone") == 1
@@ -0,0 +1,27 @@
+import timezones
+
+
+def test_every_timezone_is_reachable():
+    for region_index, region in enumerate(timezones.REGIONS):
+        zones = timezones.TIMEZONES_BY_REGION[region]
+        for zone_index, zone in enumerate(zones):
+            assert timezones.get_timezone(region_index, zone_index) == zone
+    assert timezones.get_timezone(len(timezones.REGIONS), 0) is None
+
+
+def test_keyboards_are_paginated():
+    region_index = timezones.REGIONS.index("America")
+    zones = timezones.TIMEZONES_BY_REGION["America"]
+    seen = []
+    page = 0
+    while True:
+        keyboard = timezones.get_timezone_markup(region_index, page).inline_keyboard
+        *rows, navigation = keyboard
+        buttons = [button for row in rows for button in row]
+        assert len(buttons) <= timezones.PAGE_SIZE
+        assert all(len(button.callback_data) <= 64 for button in buttons)
+        seen += buttons
+        if navigation[-1].text != "›":
+            break
+        page += 1
+    assert len(seen) == len(zones)
@@ -0,0 +1,62 @@
+import asyncio
+import random
+from datetime import datetime
+
+from telegram import Chat, Message, Update
+
+from update_processor import ChatOrderedUpdateProcessor
+
+
+def make_update(update_id: int, chat_id: int) -> Update:
+    message = Message(
+        message_id=update_id,
+        date=datetime.now(),
+        chat=Chat(id=chat_id, type=Chat.GROUP),
+        text="1337",
+    )
+    return Update(update_id=update_id, message=message)
+
+
+async def test_chats_are_processed_in_parallel():
+    processor = ChatOrderedUpdateProcessor(4)
+    blocked = asyncio.Event()
+    done = []
+
+    async def slow():
+        await blocked.wait()
+        done.append(-100)
+
+    async def fast():
+        done.append(-200)
+
+    slow_task = asyncio.create_task(
+        processor.process_update(make_update(1, -100), slow())
+    )
+    await asyncio.wait_for(processor.process_update(make_update(2, -200), fast()), 1)
+    assert done == [-200]
+
+    blocked.set()
+    await slow_task
+    assert done == [-200, -100]
+    assert not processor._locks
+
+
+async def test_updates_of_a_chat_keep_their_order():
+    processor = ChatOrderedUpdateProcessor(8)
+    processed = {-100: [], -200: []}
+
+    async def handle(update: Update):
+        await asyncio.sleep(random.random() / 100)
+        processed[update.effective_chat.id].append(update.update_id)
+
+    updates = [make_update(i, random.choice([-100, -200])) for i in range(50)]
+    await asyncio.gather(
+        *[processor.process_update(update, handle(update)) for update in updates]
+    )
+
+    for chat_id, update_ids in processed.items():
+        assert update_ids == [
+            update.update_id
+            for update in updates
+            if update.effective_chat.id == chat_id
+        ]
@@ -0,0 +1,157 @@
+from datetime import date
+
+from telegram import User
+
+import migrations
+from names import resolve
+from tests.fakes import CountingConnection
+from utils import (
+    BOT_DAY,
+    CHALLENGE_LOST,
+    TOO_EARLY,
+    WIN,
+    award,
+    build_chat_scores,
+    build_leaderboard,
+    build_stats,
+    decrease_score,
+    increase_score,
+)
+
+ALICE = User(id=1, first_name="Alice", is_bot=False)
+BOB = User(id=2, first_name="Bob", is_bot=False)
+
+
+async def test_build_chat_scores_empty(redis):
+    assert await build_chat_scores(-100) == "No one has made any points so far…"
+
+
+async def test_build_chat_scores_sorted(redis):
+    await increase_score(-100, ALICE)
+    await increase_score(-100, BOB, n=3)
+    assert await decrease_score(-100, ALICE) == 0
+    assert await build_chat_scores(-100, indent=2) == "  - Bob: 3\n  - Alice: 0"
+
+
+async def test_migrate_score_keys(redis):
+    await redis.set("group:-100:score:1", "4")
+    await redis.set("group:-100:score:2", "-2")
+    await redis.set("user:1:name", "Alice")
+    await redis.set("user:2:name", "Bob")
+    assert await migrations.migrate_score_keys() == 2
+    assert await migrations.migrate_score_keys() == 0
+    assert await redis.keys("group:-100:score:*") == []
+    assert await build_chat_scores(-100) == "- Alice: 4\n- Bob: -2"
+
+
+async def test_migrations_run_once(redis):
+    await redis.set("group:-100:score:1", "4")
+    await redis.set("user:1:name", "Alice")
+    await migrations.run()
+    await redis.set("group:-100:score:2", "1")
+    await migrations.run()
+    # Keys of the old format aren't written anymore, the second run skips the scan
+    assert await redis.get("group:-100:score:2") == "1"
+    assert await build_chat_scores(-100) == "- Alice: 4"
+
+
+async def test_award(redis):
+    scores = await award(-100, [(ALICE, 1), (BOB, -1)], last_scored_day="2024-02-01")
+    assert scores == [1, -1]
+    assert await redis.hget("group:-100:state", "last_scored_day") == "2024-02-01"
+    assert await award(-100, [(ALICE, 2)]) == [3]
+    assert await redis.hget("group:-100:state", "last_scored_day") == "2024-02-01"
+    assert await redis.hget("user:names", "2") == "Bob"
+
+
+async def test_leaderboard(redis):
+    bot = User(id=42, first_name="Bot", is_bot=True)
+    await award(-100, [(ALICE, 2), (bot, 1)], chat_title="Lunch")
+    await award(-200, [(ALICE, 1), (BOB, 2)], chat_title="Office")
+    await award(-200, [(BOB, 2)])
+
+    assert await build_leaderboard(-100) == (
+        "Top players:\n1. Bob: 4\n2. Alice: 3\n\nThis group is #2 of 2 groups."
+    )
+    assert await build_leaderboard(size=1, show_groups=True) == (
+        "Top players:\n1. Bob: 4\n\nTop groups:\n1. Office (-200): 5"
+    )
+
+    leaderboard = await redis.zrange("leaderboard:users", 0, -1, withscores=True)
+    await redis.delete("leaderboard:users", "leaderboard:groups")
+    assert await migrations.rebuild_leaderboards(bot.id) == 2
+    assert await migrations.rebuild_leaderboards(bot.id) == 0
+    assert (
+        await redis.zrange("leaderboard:users", 0, -1, withscores=True) == leaderboard
+    )
+    assert await redis.zscore("leaderboard:groups", -100) == 2
+
+
+async def test_stats(redis):
+    bot = User(id=42, first_name="Bot", is_bot=True)
+    for day in ("2024-01-31", "2024-02-01", "2024-02-02"):
+        await award(-100, [(ALICE, 1)], last_scored_day=day, event=WIN)
+    await award(-100, [(BOB, -1)], event=TOO_EARLY, day="2024-02-03")
+    await award(-100, [(bot, 2)], last_scored_day="2024-02-05", event=BOT_DAY)
+    await award(-100, [(BOB, 1)], last_scored_day="2024-02-06", event=WIN)
+    await award(-100, [(BOB, -1), (bot, 1)], event=CHALLENGE_LOST, day="2024-02-06")
+
+    assert await redis.xlen("group:-100:events") == 7
+    assert await build_stats(-100, date(2024, 2, 7)) == "\n".join(
+        [
+            "Wins: Alice 3, Bob 1",
+            "Longest winning streaks: Alice 3, Bob 1",
+            "Too early: Bob 1",
+            "Challenges lost: Bob 1",
+            "Current streak: Bob, 1 day(s)",
+            "Days won by the bot: 2",
+            "",
+            "This month: 3 wins, 1 too early, 2 days won by the bot",
+            "Points this month: Bot 3, Alice 2, Bob -1",
+        ]
+    )
+
+
+async def test_stats_count_days_won_by_the_bot_before_a_win(redis):
+    bot = User(id=42, first_name="Bot", is_bot=True)
+    await award(
+        -100,
+        [(ALICE, 1), (bot, 3)],
+        last_scored_day="2024-02-06",
+        event=WIN,
+    )
+
+    stats = await build_stats(-100, date(2024, 2, 7))
+    assert "Days won by the bot: 3" in stats
+    assert "This month: 1 wins, 0 too early, 3 days won by the bot" in stats
+    assert "Wins: Alice 1" in stats
+
+
+async def test_scoreboard_cache(redis):
+    await award(-100, [(ALICE, 2)])
+    await award(-200, [(BOB, 1)])
+    assert await build_chat_scores(-100) == "- Alice: 2"
+    round_trips = CountingConnection.round_trips
+    assert await build_chat_scores(-100) == "- Alice: 2"
+    assert CountingConnection.round_trips == round_trips
+
+    await award(-200, [(BOB, 1)])
+    assert await build_chat_scores(-100) == "- Alice: 2"
+    assert CountingConnection.round_trips == round_trips + 1
+
+    await award(-200, [(User(id=1, first_name="Alicia", is_bot=False), 1)])
+    assert await build_chat_scores(-100) == "- Alicia: 2"
+
+
+async def test_names_are_written_on_change_only(redis):
+    await award(-100, [(ALICE, 1)])
+    # Not written again while unchanged, so this edit survives
+    await redis.hset("user:names", ALICE.id, "Edited")
+    await award(-100, [(ALICE, 1)])
+    assert await redis.hget("user:names", ALICE.id) == "Edited"
+
+    await award(-100, [(User(id=1, first_name="Alicia", is_bot=False), 1)])
+    assert await redis.hget("user:names", ALICE.id) == "Alicia"
+    round_trips = CountingConnection.round_trips
+    assert await resolve([ALICE.id, 99]) == ["Alicia", None]
+    assert CountingConnection.round_trips == round_trips + 1
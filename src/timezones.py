@@ -0,0 +1,79 @@
+"""
+Index of the selectable timezones, built once on import. Keyboards only carry
+indexes into it, which keeps every callback payload a few bytes long and
+turns the selection of a timezone into a list lookup.
+"""
+
+from functools import lru_cache
+
+import pytz
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+PAGE_SIZE = 20
+COLUMNS = 2
+
+
+def _build_index() -> dict[str, list[str]]:
+    regions: dict[str, list[str]] = {}
+    for zone in pytz.common_timezones:
+        regions.setdefault(zone.partition("/")[0], []).append(zone)
+    return {region: sorted(zones) for region, zones in sorted(regions.items())}
+
+
+TIMEZONES_BY_REGION = _build_index()
+REGIONS = list(TIMEZONES_BY_REGION)
+
+
+def get_timezone(region_index: int, zone_index: int) -> str | None:
+    try:
+        return TIMEZONES_BY_REGION[REGIONS[region_index]][zone_index]
+    except IndexError:
+        return None
+
+
+def _region_button(region_index: int) -> InlineKeyboardButton:
+    region = REGIONS[region_index]
+    if TIMEZONES_BY_REGION[region] == [region]:
+        # e.g. UTC, there is nothing to choose from
+        return InlineKeyboardButton(
+            region, callback_data=f"timezone:z:{region_index}:0"
+        )
+    return InlineKeyboardButton(region, callback_data=f"timezone:r:{region_index}:0")
+
+
+@lru_cache(maxsize=None)
+def get_region_markup() -> InlineKeyboardMarkup:
+    buttons = [_region_button(i) for i in range(len(REGIONS))]
+    return InlineKeyboardMarkup([buttons[i : i + 3] for i in range(0, len(buttons), 3)])
+
+
+@lru_cache(maxsize=None)
+def get_timezone_markup(region_index: int, page: int) -> InlineKeyboardMarkup:
+    zones = TIMEZONES_BY_REGION[REGIONS[region_index]]
+    start = page * PAGE_SIZE
+    buttons = [
+        InlineKeyboardButton(
+            zone.partition("/")[2], callback_data=f"timezone:z:{region_index}:{i}"
+        )
+        for i, zone in enumerate(zones[start : start + PAGE_SIZE], start)
+    ]
+    navigation = []
+    if page > 0:
+        navigation.append(
+            InlineKeyboardButton(
+                "‹", callback_data=f"timezone:r:{region_index}:{page - 1}"
+            )
+        )
+    navigation.append(
+        InlineKeyboardButton("« Back", callback_data="timezone:region_selection")
+    )
+    if start + PAGE_SIZE < len(zones):
+        navigation.append(
+            InlineKeyboardButton(
+                "›", callback_data=f"timezone:r:{region_index}:{page + 1}"
+            )
+        )
+    return InlineKeyboardMarkup(
+        [buttons[i : i + COLUMNS] for i in range(0, len(buttons), COLUMNS)]
+        + [navigation]
+    )
@@ -1,40 +1,312 @@
-from telegram import InlineKeyboardMarkup, InlineKeyboardButton, User
+import os
+from collections import OrderedDict
+from datetime import date
+from typing import Iterable, Tuple
 
+from telegram import User
+
+import metrics
 from db import redis
+from names import NAMES_KEY, is_known, remember, resolve
+from state import group_state_key, invalidate_group_state
 
+LEADERBOARD_USERS_KEY = "leaderboard:users"
+LEADERBOARD_GROUPS_KEY = "leaderboard:groups"
+GROUP_TITLES_KEY = "leaderboard:titles"
+LEADERBOARD_SIZE = int(os.environ.get("LEADERBOARD_SIZE", 10))
+SCOREBOARD_CACHE_SIZE = int(os.environ.get("SCOREBOARD_CACHE_SIZE", 1000))
 
-def get_timezone_region_markup(continents):
-    return InlineKeyboardMarkup(
-        [
-            [
-                InlineKeyboardButton(x, callback_data=":".join(["timezone", x]))
-                for x in continents[i : i + 3]
-            ]
-            for i in range(0, len(continents), 3)
-        ]
-    )
+EVENTS_MAXLEN = int(os.environ.get("GROUP_EVENTS_MAXLEN", 10000))
+
+# (user id, name, score) of everyone in a group, highest score first
+Ranking = list[tuple[int, str | None, int]]
+
+# Types of score events, the first user of an award is the subject of the event
+WIN = "win"
+TOO_EARLY = "too_early"
+BOT_DAY = "bot_day"
+CHALLENGE_WON = "challenge_won"
+CHALLENGE_LOST = "challenge_lost"
+
+# KEYS: group scores, user names, group state, leaderboard users, leaderboard groups,
+# group titles, group events, group stats
+# ARGV: new last scored day (empty to keep it), chat id, chat title (empty to keep it),
+# event type (empty for none), event day, ordinal of the event day, max events,
+# then quadruples of user id, points, name (empty if known to be unchanged) and whether
+# the user is ranked on the leaderboard. Points of unranked users after the subject of
+# a win are days the bot won before it.
+# Returns the new scores, followed by 1 if any of the names changed
+AWARD_SCRIPT = redis.register_script(
+    """
+if ARGV[1] ~= "" then
+    redis.call("HSET", KEYS[3], "last_scored_day", ARGV[1])
+end
+if ARGV[3] ~= "" then
+    redis.call("HSET", KEYS[6], ARGV[2], ARGV[3])
+end
+local scores = {}
+local names_changed = 0
+local event = {"type", ARGV[4], "day", ARGV[5]}
+for i = 8, #ARGV, 4 do
+    scores[#scores + 1] = redis.call("ZINCRBY", KEYS[1], ARGV[i + 1], ARGV[i])
+    if ARGV[i + 2] ~= "" and redis.call("HGET", KEYS[2], ARGV[i]) ~= ARGV[i + 2] then
+        redis.call("HSET", KEYS[2], ARGV[i], ARGV[i + 2])
+        names_changed = 1
+    end
+    if ARGV[i + 3] == "1" then
+        redis.call("ZINCRBY", KEYS[4], ARGV[i + 1], ARGV[i])
+        redis.call("ZINCRBY", KEYS[5], ARGV[i + 1], ARGV[2])
+    end
+    event[#event + 1] = "user:" .. ARGV[i]
+    event[#event + 1] = ARGV[i + 1]
+end
+scores[#scores + 1] = names_changed
+if ARGV[4] == "" then
+    return scores
+end
+
+local kind, subject, points = ARGV[4], ARGV[8], ARGV[9]
+local month = string.sub(ARGV[5], 1, 7)
+redis.call("XADD", KEYS[7], "MAXLEN", "~", ARGV[7], "*", unpack(event))
+if kind == "bot_day" then
+    redis.call("HINCRBY", KEYS[8], "bot_day", points)
+    redis.call("HINCRBY", KEYS[8], month .. ":bot_day", points)
+else
+    redis.call("HINCRBY", KEYS[8], kind .. ":" .. subject, 1)
+    redis.call("HINCRBY", KEYS[8], month .. ":" .. kind, 1)
+end
+if kind == "win" then
+    for i = 12, #ARGV, 4 do
+        if ARGV[i + 3] == "0" then
+            redis.call("HINCRBY", KEYS[8], "bot_day", ARGV[i + 1])
+            redis.call("HINCRBY", KEYS[8], month .. ":bot_day", ARGV[i + 1])
+        end
+    end
+end
+for i = 8, #ARGV, 4 do
+    redis.call("HINCRBY", KEYS[8], month .. ":points:" .. ARGV[i], ARGV[i + 1])
+end
+if kind == "win" then
+    local day = tonumber(ARGV[6])
+    local last = redis.call("HMGET", KEYS[8], "last_winner", "last_win_day", "streak:" .. subject)
+    local streak = 1
+    if last[1] == subject and tonumber(last[2]) == day - 1 then
+        streak = tonumber(last[3]) + 1
+    end
+    redis.call("HSET", KEYS[8], "last_winner", subject, "last_win_day", day, "streak:" .. subject, streak)
+    local best = redis.call("HGET", KEYS[8], "best_streak:" .. subject)
+    if not best or streak > tonumber(best) then
+        redis.call("HSET", KEYS[8], "best_streak:" .. subject, streak)
+    end
+end
+return scores
+"""
+)
+
+
+def is_player(user: User) -> bool:
+    """
+    Bots, including this one, are not ranked on the leaderboard.
+    """
+    return isinstance(user, User) and not user.is_bot
+
+
+# Rankings of groups by chat_id, along with the versions they were read at. A
+# group's version is bumped on every change of its scores, the names version on
+# any change of a name, so a cached ranking is valid as long as both versions
+# are unchanged. Changes made outside of ``award``, like editing redis by hand,
+# are only picked up with the next award.
+_rankings: OrderedDict[int, tuple[tuple[int, int], Ranking]] = OrderedDict()
+_score_versions: dict[int, int] = {}
+_names_version = 0
+
+
+def invalidate_scoreboards(chat_id: int | None = None, names=False):
+    global _names_version
+    if chat_id is not None:
+        _score_versions[chat_id] = _score_versions.get(chat_id, 0) + 1
+    if names:
+        _names_version += 1
+
+
+async def get_ranking(chat_id: int) -> Ranking:
+    """
+    User id, name and score of everyone in the group, highest score first.
+    """
+    version = (_score_versions.get(chat_id, 0), _names_version)
+    if (cached := _rankings.get(chat_id)) and cached[0] == version:
+        _rankings.move_to_end(chat_id)
+        metrics.SCOREBOARD_CACHE_HITS.inc()
+        return cached[1]
+    metrics.SCOREBOARD_CACHE_MISSES.inc()
+    scores = await redis.zrevrange(f"group:{chat_id}:scores", 0, -1, withscores=True)
+    names = await resolve([user_id for user_id, _ in scores])
+    ranking = [
+        (int(user_id), name, int(value))
+        for name, (user_id, value) in zip(names, scores)
+    ]
+    # Cached under the versions from before the reads, an award that raced
+    # with them makes the next call read again
+    _rankings[chat_id] = (version, ranking)
+    _rankings.move_to_end(chat_id)
+    if len(_rankings) > SCOREBOARD_CACHE_SIZE:
+        _rankings.popitem(last=False)
+    return ranking
 
 
-def build_chat_scores(chat_id: int, indent: int = 0):
-    scores = []
-    for key in redis.scan_iter(f"group:{chat_id}:score:*"):
-        user_id = int(key.rpartition(":")[2])
-        name = redis.get(f"user:{user_id}:name")
-        value = int(redis.get(key))
-        scores.append((name, value))
-    if not scores:
+async def build_chat_scores(chat_id: int, indent: int = 0):
+    ranking = await get_ranking(chat_id)
+    if not ranking:
         return "No one has made any points so far…"
-    scores = sorted(scores, key=lambda x: x[1], reverse=True)
     space = " " * indent
-    return "\n".join([f"{space}- {x[0]}: {x[1]}" for x in scores])
+    return "\n".join([f"{space}- {name}: {score}" for _, name, score in ranking])
+
+
+async def award(
+    chat_id: int,
+    points: Iterable[Tuple[User, int]],
+    last_scored_day: str | None = None,
+    chat_title: str | None = None,
+    event: str | None = None,
+    day: str | None = None,
+) -> list[int]:
+    """
+    Atomically adds points to the given users, refreshes changed names, updates
+    the leaderboard and optionally moves the last scored day of the group, in
+    a single round trip. With an ``event``, the change is appended to the
+    event stream of the group and its stats are updated. ``day`` defaults to
+    the last scored day. Returns the new scores in the order of ``points``.
+    """
+    day = day or last_scored_day or ""
+    ordinal = date.fromisoformat(day).toordinal() if day else 0
+    args = [
+        last_scored_day or "",
+        chat_id,
+        chat_title or "",
+        event or "",
+        day,
+        ordinal,
+        EVENTS_MAXLEN,
+    ]
+    points = list(points)
+    for user, n in points:
+        name = "" if is_known(user.id, user.first_name) else user.first_name
+        args += [user.id, n, name, int(is_player(user))]
+    *scores, names_changed = await AWARD_SCRIPT(
+        keys=[
+            f"group:{chat_id}:scores",
+            NAMES_KEY,
+            group_state_key(chat_id),
+            LEADERBOARD_USERS_KEY,
+            LEADERBOARD_GROUPS_KEY,
+            GROUP_TITLES_KEY,
+            f"group:{chat_id}:events",
+            f"group:{chat_id}:stats",
+        ],
+        args=args,
+        client=redis,
+    )
+    for user, _ in points:
+        remember(user.id, user.first_name)
+    invalidate_scoreboards(chat_id, names=bool(names_changed))
+    if last_scored_day:
+        invalidate_group_state(chat_id)
+    return [int(float(score)) for score in scores]
+
+
+async def increase_score(chat_id: int, user: User, n=1) -> int:
+    return (await award(chat_id, [(user, n)]))[0]
+
+
+async def decrease_score(chat_id: int, user: User, n=1) -> int:
+    return await increase_score(chat_id, user, n * -1)
+
+
+async def build_leaderboard(
+    chat_id: int | None = None, size: int = LEADERBOARD_SIZE, show_groups=False
+) -> str:
+    """
+    Renders the top players of all groups. With ``show_groups``, the top
+    groups are listed by title, otherwise only the rank of ``chat_id``.
+    """
+    pipe = redis.pipeline()
+    pipe.zrevrange(LEADERBOARD_USERS_KEY, 0, size - 1, withscores=True)
+    pipe.zcard(LEADERBOARD_GROUPS_KEY)
+    pipe.zrevrank(LEADERBOARD_GROUPS_KEY, chat_id or 0)
+    if show_groups:
+        pipe.zrevrange(LEADERBOARD_GROUPS_KEY, 0, size - 1, withscores=True)
+    users, group_count, rank, *groups = await pipe.execute()
+    if not users:
+        return "No one has made any points so far…"
+    names = await resolve([user_id for user_id, _ in users])
+    if show_groups:
+        titles = await redis.hmget(
+            GROUP_TITLES_KEY, [group_id for group_id, _ in groups[0]]
+        )
+
+    lines = ["Top players:"]
+    lines += [
+        f"{i}. {name or user_id}: {int(score)}"
+        for i, (name, (user_id, score)) in enumerate(zip(names, users), 1)
+    ]
+    if show_groups:
+        lines += ["", "Top groups:"]
+        lines += [
+            f"{i}. {title or group_id} ({group_id}): {int(score)}"
+            for i, (title, (group_id, score)) in enumerate(zip(titles, groups[0]), 1)
+        ]
+    if chat_id is not None and rank is not None:
+        lines += ["", f"This group is #{rank + 1} of {group_count} groups."]
+    return "\n".join(lines)
+
+
+STATS_TITLES = {
+    WIN: "Wins",
+    "best_streak": "Longest winning streaks",
+    TOO_EARLY: "Too early",
+    CHALLENGE_WON: "Challenges won",
+    CHALLENGE_LOST: "Challenges lost",
+}
 
 
-def increase_score(chat_id: int, user: User, n=1):
-    score_str = redis.get(f"group:{chat_id}:score:{user.id}")
-    score = int(score_str or 0)
-    redis.set(f"group:{chat_id}:score:{user.id}", score + n)
-    redis.set(f"user:{user.id}:name", user.first_name)
+async def build_stats(chat_id: int, today: date) -> str:
+    """
+    Renders the stats of a group, which are kept up to date by ``award``.
+    """
+    stats = await redis.hgetall(f"group:{chat_id}:stats")
+    if not stats:
+        return "Nothing has happened here so far…"
+    month = today.strftime("%Y-%m")
+    per_user = {}
+    for field, value in stats.items():
+        name, _, user_id = field.rpartition(":")
+        if name in STATS_TITLES or name == f"{month}:points":
+            per_user.setdefault(name, []).append((user_id, int(value)))
+    user_ids = {user_id for values in per_user.values() for user_id, _ in values}
+    user_ids.add(stats.get("last_winner", ""))
+    user_ids = sorted(user_ids - {""})
+    names = dict(zip(user_ids, await resolve(user_ids)))
 
+    def ranking(values):
+        values = sorted(values, key=lambda value: -value[1])
+        return ", ".join(f"{names[user_id] or user_id} {n}" for user_id, n in values)
 
-def decrease_score(chat_id: int, user: User, n=1):
-    increase_score(chat_id, user, n * -1)
+    lines = [
+        f"{title}: {ranking(per_user[name])}"
+        for name, title in STATS_TITLES.items()
+        if name in per_user
+    ]
+    if int(stats.get("last_win_day", 0)) >= today.toordinal() - 1:
+        winner = stats["last_winner"]
+        streak = stats[f"streak:{winner}"]
+        lines.append(f"Current streak: {names[winner] or winner}, {streak} day(s)")
+    lines.append(f"Days won by the bot: {stats.get(BOT_DAY, 0)}")
+    lines += [
+        "",
+        f"This month: {stats.get(f'{month}:{WIN}', 0)} wins, "
+        f"{stats.get(f'{month}:{TOO_EARLY}', 0)} too early, "
+        f"{stats.get(f'{month}:{BOT_DAY}', 0)} days won by the bot",
+    ]
+    if points := per_user.get(f"{month}:points"):
+        lines.append(f"Points this month: {ranking(points)}")
+    return "\n".join(lines)